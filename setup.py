@@ -36,6 +36,7 @@ setup(name='sparc.cache',
           'SQLAlchemy',
           'zope.event',
           'zope.lifecycleevent',
+          'requests',
           'sparc.common',
           'sparc.db',
           'sparc.utils'
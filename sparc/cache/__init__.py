@@ -10,4 +10,5 @@ from sparc.cache.interfaces import ICachableSource
 from sparc.cache.interfaces import ICacheArea
 from sparc.cache.interfaces import ITransactionalCacheArea
 from sparc.cache.interfaces import ITrimmableCacheArea
+from sparc.cache.interfaces import ISweepableCacheArea
 from sparc.cache.interfaces import ILocatableCacheArea
@@ -0,0 +1,58 @@
+import hashlib
+import math
+import struct
+
+class BloomFilter(object):
+    """A compact, probabilistic set of keys
+    
+    Membership tests never miss a key that was added, but may report keys 
+    that were not added (false positives) at about error_rate while no more 
+    than capacity keys have been added.  The false positive rate grows as 
+    more keys are added.
+    
+    Attributes:
+        count: number of add() calls
+    """
+    
+    def __init__(self, capacity, error_rate=0.01):
+        """Object initialization
+        
+        Args:
+            capacity: Integer number of keys the filter is sized for
+            error_rate: Float false positive rate wanted at capacity
+        """
+        if capacity < 1:
+            raise ValueError("expected filter capacity to be a positive integer: %s" % str(capacity))
+        if not 0 < error_rate < 1:
+            raise ValueError("expected filter error rate between 0 and 1: %s" % str(error_rate))
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = 0
+        self._bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._hashes = max(1, int(round(self._bits * math.log(2) / capacity)))
+        self._array = bytearray((self._bits + 7) // 8)
+    
+    def _positions(self, key):
+        """Returns generator of the bit positions for key (double hashing)"""
+        if not isinstance(key, bytes):
+            key = (key if isinstance(key, type(u'')) else str(key)).encode('utf8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        for i in range(self._hashes):
+            yield (h1 + i * h2) % self._bits
+    
+    def add(self, key):
+        """Adds key to the filter"""
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+    
+    def update(self, keys):
+        """Adds each key of iterable keys to the filter"""
+        for key in keys:
+            self.add(key)
+    
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self._array[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
@@ -147,6 +147,24 @@ class ITrimmableCacheArea(ICacheArea):
             from the cache.
         """
 
+class ISweepableCacheArea(ICacheArea):
+    """An area whose expired entries can be removed in bulk
+    
+    This should be used in cases where cached entries are only valid for a
+    limited time, to keep the cache area from growing without limit
+    """
+    
+    def sweep(now=None):
+        """Removes all entries from the cache area that expired before now
+        
+        Args:
+            now: Python datetime to compare entry expirations to, defaults
+                 to the current time
+        Returns:
+            number of entries removed from the cache area, or None if the
+            cache area can not tell.
+        """
+
 class ILocatableCacheArea(ICacheArea):
     """
     Same as ICacheArea except zope.location.ILocation must be provided by
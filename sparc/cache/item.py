@@ -1,8 +1,11 @@
 import datetime
+import hashlib
 import inspect
-from zope.interface import alsoProvides
-from zope.interface import implements
-from zope.component import subscribers
+import re
+from operator import attrgetter
+from weakref import WeakKeyDictionary
+from zope.interface import implements, providedBy
+from zope.component import getSiteManager
 from zope.component.interfaces import IFactory
 from zope.component.factory import Factory
 from zope.schema import getFieldNames
@@ -17,24 +20,106 @@ def schema_map(schema):
     for name in getFieldNames(schema):
         mapper[name] = name
     return mapper
+# registry -> CachedItemFactory -> {(source type, source interfaces, header
+# schema): resolved ICachedItemMapper subscription adapter factory}
+_resolved_mappers = WeakKeyDictionary()
+MAX_RESOLVED_MAPPERS = 1000 # per registry and CachedItemFactory
+
+def invalidateCachedItemMappers(event=None):
+    """Forget the mappers resolved by CachedItemMapperFactory
+    
+    Registered as a handler for component registration events, so mappers
+    are resolved again once subscription adapters are (un)registered.
+    """
+    _resolved_mappers.clear()
 
 class CachedItemMapperFactory(object):
+    """Create ICachedItemMapper from ICachableSource, CachedItemFactory
+    
+    The first subscribed ICachedItemMapper whose check() accepts the source's
+    first item is returned.  The resolved subscription adapter factory is
+    remembered by source type, header schema and CachedItemFactory, so later
+    calls for like sources skip the subscriber checks.  The header schema is
+    the source's fieldnames() when it has one (e.g. CSVSource), otherwise
+    the attribute names of its first item.  Remembered mappers are forgotten
+    when the component registry changes, or by invalidate().
+    """
     implements(IFactory)
     
     title = u"Create object with ICachedItemMapper from ICachableSource, CachedItemFactory"
     description = u"Allows for easy ICachedItemMapper generation"
     
     def __call__(self, CachableSource, CachedItemFactory):
-        item = CachableSource.first()
-        if not item:
-            raise ValueError("expected CachableSource to be able to generate at least 1 item.")
-        for mapper in subscribers((CachableSource,CachedItemFactory,), ICachedItemMapper):
+        objects = (CachableSource, CachedItemFactory,)
+        registry = getSiteManager()
+        resolved = self._resolved(registry, CachedItemFactory)
+        item = None
+        schema = self._fieldnames(CachableSource)
+        if schema is None:
+            item = self._first(CachableSource)
+            schema = self._attribute_names(item)
+        key = None
+        if resolved is not None and schema is not None:
+            key = (type(CachableSource), providedBy(CachableSource), schema)
+        if key is not None and key in resolved:
+            logger.debug("using resolved ICachedItemMapper factory %s", str(resolved[key]))
+            mapper = resolved[key](*objects)
+            if mapper is not None:
+                return mapper
+            del resolved[key]
+        if item is None:
+            item = self._first(CachableSource)
+        for factory in registry.adapters.subscriptions(map(providedBy, objects), ICachedItemMapper):
+            mapper = factory(*objects)
+            if mapper is None:
+                continue
             logger.debug("testing mapper/cachedItem combination: %s, %s", str(mapper), str(CachedItemFactory))
             if mapper.check(item):
                 logger.debug("found valid ICachedItemMapper %s", str(mapper))
+                if key is not None:
+                    if len(resolved) >= MAX_RESOLVED_MAPPERS:
+                        resolved.clear()
+                    resolved[key] = factory
                 return mapper
             logger.debug("skipping CachedItemMapper %s because item failed mapper validation check", str(mapper))
-        raise LookupError("unable to find subscribed ICachedItemMapper for given source and factory: %s, %s", str(CachableSource). str(CachedItemFactory))
+        raise LookupError("unable to find subscribed ICachedItemMapper for given source and factory: %s, %s" % (str(CachableSource), str(CachedItemFactory)))
+    
+    def _resolved(self, registry, CachedItemFactory):
+        """Returns dict of resolved mappers for registry and CachedItemFactory,
+           None if they can not be weakly referenced
+        """
+        try:
+            factories = _resolved_mappers.setdefault(registry, WeakKeyDictionary())
+            return factories.setdefault(CachedItemFactory, {})
+        except TypeError:
+            return None
+    
+    def _first(self, CachableSource):
+        item = CachableSource.first()
+        if not item:
+            raise ValueError("expected CachableSource to be able to generate at least 1 item.")
+        return item
+    
+    def _fieldnames(self, CachableSource):
+        """Returns sorted tuple of the source's fieldnames(), None if the
+           source has none
+        """
+        fieldnames = getattr(CachableSource, 'fieldnames', None)
+        if not callable(fieldnames):
+            return None
+        names = fieldnames()
+        return None if names is None else tuple(sorted(names))
+    
+    def _attribute_names(self, item):
+        """Returns sorted tuple of item's attribute names, None if unavailable"""
+        try:
+            return tuple(sorted(item.attributes.keys()))
+        except (AttributeError, TypeError):
+            return None
+    
+    def invalidate(self):
+        """Forget all resolved mappers"""
+        invalidateCachedItemMappers()
     
     def getInterfaces(self):
         return [ICachedItemMapper]
@@ -78,37 +163,91 @@ class CachableItemFromSchema(cachableItemMixin):
                 self.attributes[name] = getattr(object, name)
 cachableItemFromSchemaFactory = Factory(CachableItemFromSchema)
 
+def _canonical(value):
+    """Returns value with text as UTF-8 str and integers as int, recursing 
+       into tuples and lists
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (int, long)):
+        return int(value)
+    if isinstance(value, (tuple, list)):
+        return type(value)(_canonical(v) for v in value)
+    return value
+
+def values_digest(values):
+    """Returns hex digest of the sequence of values
+    
+    Text values are hashed as UTF-8 and integers as int, so values that
+    compare equal as str and unicode (or int and long) have equal digests.
+    """
+    return hashlib.sha1(repr(_canonical(tuple(values)))).hexdigest()
+
+_eq_fields = WeakKeyDictionary() # cachedItemMixin class: compared field names
+
+def _values(item, fields):
+    """Returns tuple of item's values for fields"""
+    if not fields:
+        return ()
+    values = attrgetter(*fields)(item)
+    return values if len(fields) > 1 else (values, )
+
 class cachedItemMixin(object):
     """Base class for ICachedItem implementations
+    
+    The names of the fields checked for equivalence are worked out once per
+    class (see _eq_fields()).
     """
     implements(ICachedItem)
+    __slots__ = () # allows subclasses to use __slots__
     
     _key = 'Must be defined by implementers'
     # implementers can place a list of Interfaces here that will used when checking
-    # equivalence.  Otherwise all attributes are checked minus getId() and those 
+    # equivalence.  Otherwise all attributes are checked minus methods and those 
     # starting with '_'
     _eq_checked_interfaces = [] 
     
     def getId(self):
         return getattr(self, self._key)
     
-    def __eq__(self, instance):
-        attributes = []
+    def _eq_fields(self):
+        """Returns tuple of the field names checked for equivalence"""
+        _class = self.__class__
+        fields = _eq_fields.get(_class)
+        if fields is None:
+            names = []
+            if self._eq_checked_interfaces:
+                for iface in self._eq_checked_interfaces:
+                    for name in iface:
+                        if name not in names:
+                            names.append(name)
+            else:
+                names = [name for name, value in inspect.getmembers(_class)
+                            if not name.startswith("_") and 
+                                                not inspect.isroutine(value)]
+            fields = _eq_fields[_class] = tuple(names)
         if self._eq_checked_interfaces:
-            for iface in self._eq_checked_interfaces:
-                for name in iface:
-                    attributes.append(name)
-        else:
-            for name, value in inspect.getmembers(self):
-                if name.startswith("_") or name in ['getId']:
-                    continue
-                attributes.append(name)
-        for name in attributes:
-            if not hasattr(instance, name):
-                return False
-            if getattr(self, name) != getattr(instance, name):
-                return False
-        return True
+            return fields
+        # attributes only assigned to the instance are checked as well
+        extra = [name for name in getattr(self, '__dict__', ())
+                            if not name.startswith("_") and name not in fields]
+        return fields + tuple(sorted(extra)) if extra else fields
+    
+    def content_hash(self):
+        """Returns hex digest of the values of the fields checked for 
+           equivalence
+        
+        Equivalent items have the same digest, so digests can be stored and
+        compared in place of the items (see values_digest()).
+        """
+        return values_digest(_values(self, self._eq_fields()))
+    
+    def __eq__(self, instance):
+        fields = self._eq_fields()
+        try:
+            return _values(self, fields) == _values(instance, fields)
+        except AttributeError:
+            return False
    
     def __ne__(self, instance):
         return not self.__eq__(instance)
@@ -151,17 +290,27 @@ class ageableCacheItemMixin(cachedItemMixin):
     def expiration_age(self):
         return self._expiration_age
     def expired(self):
-        return datetime.datetime.now > self._expiration
+        return datetime.datetime.now() > self._expiration
+
+def _slot_name(name):
+    """True if name can be used in __slots__ of a cachedItemMixin class"""
+    return isinstance(name, basestring) and bool(_identifier.match(name)) \
+                and not name.startswith('__') and not hasattr(cachedItemMixin, name)
+_identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
 
 class SimpleItemMapper(object):
     """A simple attribute item mapper
     
-    A very simple implementation that will generate on-the-fly ICachedItem
-    objects with one-to-one mappings to ICachableItem.attributes key/value.
+    A very simple implementation that will generate ICachedItem objects with
+    one-to-one mappings to ICachableItem.attributes key/value.  The 
+    ICachedItem class is generated once per mapper.  With slots set (and 
+    all the attribute keys valid Python identifiers), the class uses 
+    __slots__, so its instances are small, but only accept the mapped 
+    attributes and can not be pickled with protocols 0 and 1.
     """
     implements(ICachedItemMapper)
     
-    def __init__(self, key, CacheableItem, filter=None):
+    def __init__(self, key, CacheableItem, filter=None, slots=False):
         """Init
         
         Args:
@@ -173,27 +322,41 @@ class SimpleItemMapper(object):
                     attribute name, the second is the ICachableItem value of
                     that attribute.  The return value should be what will be
                     assigned to the related attribute on the ICacheItem
+            slots: When True, the ICachedItem class uses __slots__ if the 
+                   attribute keys allow it
         """
         self._key = key
         self.mapper = {k:k for k in CacheableItem.attributes}
         self.filter = filter if filter else lambda x,y:y
+        self.slots = slots
+        self._class = self._item_class()
+    
+    def _item_class(self):
+        """Returns generated cachedItemMixin class for the mapper keys"""
+        names = sorted(self.mapper.keys())
+        if self.slots and all(_slot_name(name) for name in names):
+            names = [str(name) for name in names]
+            def __init__(self):
+                for name in names:
+                    setattr(self, name, None)
+            namespace = {'__slots__': names, '__init__': __init__}
+        else:
+            namespace = {name:None for name in names}
+        namespace['_key'] = self.key()
+        return type('SimpleItemMapperCachedItem', (cachedItemMixin,), namespace)
     
     #ICachedItemMapper
     def key(self):
         return self._key
     
     def factory(self):
-        #base = cachedItemMixin()
-        #base._key = self.key()
-        ci = type('SimpleItemMapperCachedItem', (cachedItemMixin,), {key:None for key in self.mapper.keys()})()
-        ci._key = self.key()
-        alsoProvides(ci, ICachedItem)
-        return ci
+        return self._class()
     
     def get(self, CachableItem):
-        ci = self.factory()
+        ci = self._class()
+        attributes = CachableItem.attributes
         for name in self.mapper:
-            setattr(ci, name, self.filter(name, CachableItem.attributes[name]))
+            setattr(ci, name, self.filter(name, attributes[name]))
         return ci
     
     def check(self, CachableItem):
@@ -0,0 +1,241 @@
+import sqlite3
+import threading
+from itertools import islice
+from zope.interface import alsoProvides, implements
+from zope.component.factory import Factory
+from sparc.cache import ICacheArea, ITransactionalCacheArea, ITrimmableCacheArea, ISweepableCacheArea, ICachableSource
+from sparc.cache.item import values_digest
+
+from sparc.logging import logging
+logger = logging.getLogger(__name__)
+
+LOOKUP_BATCH_SIZE = 500 # below SQLite's default limit of 999 query parameters
+
+def _id(CachableItem):
+    """Returns unicode journal key of CachableItem, decoding byte string ids
+       as UTF-8 (undecodable bytes are replaced)
+    """
+    id_ = CachableItem.getId()
+    if isinstance(id_, str):
+        return id_.decode('utf-8', 'replace')
+    return u'%s' % id_
+
+class JournaledCacheArea(object):
+    """ICacheArea wrapper that skips items unchanged since they were cached
+    
+    A local SQLite journal holds a digest of the content of every item cached
+    through the wrapper.  Items whose digest matches their journal entry are
+    skipped by isDirty(), cache() and import_source() without reaching the
+    wrapped area, so re-importing a mostly unchanged source only sends the
+    changed items to a (typically remote) area.
+    
+    Digests are the content_hash() of the items created by the area's mapper
+    when available, otherwise a hash of the ICachableItem attributes.
+    Journal entries are written once the area has cached the items, and, for
+    ITransactionalCacheArea areas, only when the wrapper is committed.
+    trim(), reset() and sweep() remove entries from the area that are not
+    tracked individually, so they clear the journal.
+    
+    The journal assumes the wrapper is the only writer of the area.  Changes
+    made to the area by other means are not noticed for journaled items
+    (clear() the journal to have all items checked again).
+    
+    The wrapper provides the ITransactionalCacheArea, ITrimmableCacheArea
+    and ISweepableCacheArea interfaces of the wrapped area.
+    """
+    implements(ICacheArea)
+    
+    def __init__(self, CacheArea, path):
+        """Object initialization
+    
+        Args:
+            CacheArea: ICacheArea to wrap
+            path: String path of the SQLite journal file (created if
+                  missing), or ':memory:' for a journal that is not kept
+        """
+        self.area = CacheArea
+        self.path = path
+        self._pending = {} # id: digest, written on commit()
+        self._pending_clear = False
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS journal "
+                         "(id TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+        self._db.commit()
+        for iface in (ITransactionalCacheArea, ITrimmableCacheArea,
+                      ISweepableCacheArea, ):
+            if iface.providedBy(CacheArea):
+                alsoProvides(self, iface)
+    
+    def _transactional(self):
+        return ITransactionalCacheArea.providedBy(self.area)
+    
+    def digest(self, CachableItem):
+        """Returns string digest of the content of ICachableItem"""
+        mapper = getattr(self.area, 'mapper', None)
+        if mapper is not None:
+            _cachedItem = mapper.get(CachableItem)
+            if hasattr(_cachedItem, 'content_hash'):
+                return _cachedItem.content_hash()
+        _values = sorted(CachableItem.attributes.items())
+        return values_digest(_values)
+    
+    def _digests(self, ids):
+        """Returns dict of journaled digests keyed by id for the given ids"""
+        ids = list(ids)
+        with self._lock:
+            if self._pending_clear:
+                return {}
+            return dict(self._db.execute("SELECT id, digest FROM journal "
+                        "WHERE id IN (%s)" % ','.join('?' * len(ids)), ids))
+    
+    def _unchanged(self, CachableItem, digest):
+        """True if the journaled digest of CachableItem matches digest"""
+        id_ = _id(CachableItem)
+        if id_ in self._pending:
+            return self._pending[id_] == digest
+        return self._digests([id_]).get(id_) == digest
+    
+    def _record(self, digests):
+        """Journals dict of id: digest entries, on commit() for
+           ITransactionalCacheArea areas
+        """
+        if self._transactional():
+            self._pending.update(digests)
+        else:
+            self._write(digests)
+    
+    def _write(self, digests, clear=False):
+        with self._lock:
+            if clear:
+                self._db.execute("DELETE FROM journal")
+            self._db.executemany("INSERT OR REPLACE INTO journal (id, digest) "
+                                 "VALUES (?, ?)", digests.items())
+            self._db.commit()
+    
+    def clear(self):
+        """Removes all journal entries"""
+        self._pending.clear()
+        self._pending_clear = False
+        self._write({}, clear=True)
+    
+    def _changed(self, CachableItems, digests):
+        """Returns generator of the CachableItems whose digests differ from
+           the journal, adding their digests to the digests dict
+        """
+        iterator = iter(CachableItems)
+        while True:
+            chunk = list(islice(iterator, LOOKUP_BATCH_SIZE))
+            if not chunk:
+                return
+            _digests = [self.digest(item) for item in chunk]
+            _journaled = self._digests(_id(item) for item in chunk)
+            for item, digest in zip(chunk, _digests):
+                id_ = _id(item)
+                if self._pending.get(id_, _journaled.get(id_)) == digest:
+                    continue
+                digests[id_] = digest
+                yield item
+    
+    #ICacheArea
+    def get(self, CachableItem):
+        return self.area.get(CachableItem)
+    
+    def isDirty(self, CachableItem):
+        if self._unchanged(CachableItem, self.digest(CachableItem)):
+            return False
+        return self.area.isDirty(CachableItem)
+    
+    def cache(self, CachableItem):
+        """Updates the wrapped area with CachableItem unless it is journaled
+           as unchanged, in which case False is returned
+        """
+        digest = self.digest(CachableItem)
+        if self._unchanged(CachableItem, digest):
+            return False
+        cached_item = self.area.cache(CachableItem)
+        self._record({_id(CachableItem): digest})
+        return cached_item
+    
+    def import_source(self, CachableSource):
+        """Updates the wrapped area with the items of CachableSource whose
+           journal entries differ, returning the area's update count
+        """
+        digests = {}
+        _source = _ChangedItemsSource(CachableSource,
+                                self._changed(CachableSource.items(), digests))
+        count = self.area.import_source(_source)
+        self._record(digests)
+        logger.debug("journaled cache area passed %d changed items to %s", len(digests), str(self.area))
+        return count
+    
+    def reset(self):
+        self.clear()
+        self.area.reset()
+    
+    def initialize(self):
+        self.area.initialize()
+    
+    #ITransactionalCacheArea
+    def commit(self):
+        """Commits the wrapped area, then journals the items cached since the
+           last commit or rollback
+        """
+        self.area.commit()
+        with self._lock:
+            pending, clear = self._pending, self._pending_clear
+            self._pending, self._pending_clear = {}, False
+        self._write(pending, clear)
+    
+    def rollback(self):
+        self.area.rollback()
+        self._pending.clear()
+        self._pending_clear = False
+    
+    #ITrimmableCacheArea
+    def trim(self, source):
+        """Trims the wrapped area with source, after which the journal holds
+           the items of source only
+        """
+        items = source.items() if ICachableSource.providedBy(source) else source
+        digests = {}
+        def record(items):
+            for item in items:
+                digests[_id(item)] = self.digest(item)
+                yield item
+        counts = self.area.trim(record(items))
+        if self._transactional():
+            self._pending = digests
+            self._pending_clear = True
+        else:
+            self._write(digests, clear=True)
+        return counts
+    
+    #ISweepableCacheArea
+    def sweep(self, now=None):
+        """Sweeps the wrapped area, clearing the journal"""
+        removed = self.area.sweep(now)
+        self.clear()
+        return removed
+
+class _ChangedItemsSource(object):
+    """ICachableSource of the changed items of a source"""
+    implements(ICachableSource)
+    
+    def __init__(self, CachableSource, items):
+        self.source = CachableSource
+        self._items = items
+    
+    def key(self):
+        return self.source.key()
+    
+    def items(self):
+        return self._items
+    
+    def getById(self, Id):
+        return self.source.getById(Id)
+    
+    def first(self):
+        return self.source.first()
+
+journaledCacheAreaFactory = Factory(JournaledCacheArea)
@@ -0,0 +1,57 @@
+import time
+from collections import OrderedDict
+
+class LRUCache(object):
+    """A bounded, least recently used, in-memory cache with optional entry ttl
+    
+    Attributes:
+        hits: number of get() calls that found a valid entry
+        misses: number of get() calls that did not find a valid entry
+    """
+    
+    def __init__(self, size, ttl=None):
+        """Object initialization
+        
+        Args:
+            size: Integer maximum number of entries to keep
+            ttl: Number of seconds an entry is valid for, entries do not 
+                 expire when not set
+        """
+        if size < 1:
+            raise ValueError("expected cache size to be a positive integer: %s" % str(size))
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key: (value, expiration time)
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __contains__(self, key):
+        return key in self._entries
+    
+    def get(self, key, default=None):
+        """Returns value for key or default if not found or expired"""
+        entry = self._entries.pop(key, None)
+        if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+            self.misses += 1
+            return default
+        self._entries[key] = entry # most recently used entries are last
+        self.hits += 1
+        return entry[0]
+    
+    def set(self, key, value):
+        """Stores value for key, evicting the least recently used entry if full"""
+        self._entries.pop(key, None)
+        self._entries[key] = (value, time.time() + self.ttl if self.ttl else None, )
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+    
+    def invalidate(self, key):
+        """Removes key's entry if available"""
+        self._entries.pop(key, None)
+    
+    def clear(self):
+        """Removes all entries"""
+        self._entries.clear()
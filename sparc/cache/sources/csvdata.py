@@ -1,14 +1,128 @@
 from zope.interface import implements
 from zope.component.factory import Factory
+import mmap
 import os.path
-from csv import DictReader
+from csv import DictReader, reader
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
-from sparc.cache.interfaces import ICachableSource
+from sparc.cache.interfaces import ICachableItem, ICachableSource
 
 from sparc.logging import logging
 logger = logging.getLogger(__name__)
 
+class CSVRecordSchema(object):
+    """Field names and key shared by the CSVRecord rows of a CSV file"""
+    __slots__ = ('fields', 'index', 'key')
+    
+    def __init__(self, fields, key):
+        self.fields = tuple(fields)
+        self.index = {name:i for i, name in enumerate(self.fields)}
+        self.key = key
+
+class CSVRecord(object):
+    """Compact ICachableItem for a CSV row
+    
+    The row values are kept in a tuple, and the field names in a 
+    CSVRecordSchema shared by all rows of the file.  The record is its own
+    read-only attributes mapping.
+    """
+    implements(ICachableItem)
+    __slots__ = ('schema', '_values')
+    
+    def __init__(self, schema, values):
+        self.schema = schema
+        self._values = values
+    
+    @property
+    def key(self):
+        return self.schema.key
+    
+    @property
+    def attributes(self):
+        return self
+    
+    def getId(self):
+        return self[self.schema.key]
+    
+    def validate(self):
+        if self.schema.key not in self.schema.index:
+            raise KeyError("expected item's attributes to have entry for key field: %s in keys: %s", self.schema.key, str(self.keys()))
+        if not self.getId():
+            raise ValueError("expected item's key attribute to have a non-empty value")
+    
+    # read-only mapping of field names to row values
+    def __getitem__(self, name):
+        return self._values[self.schema.index[name]]
+    
+    def get(self, name, default=None):
+        i = self.schema.index.get(name)
+        return default if i is None else self._values[i]
+    
+    def __contains__(self, name):
+        return name in self.schema.index
+    has_key = __contains__
+    
+    def __iter__(self):
+        return iter(self.schema.fields)
+    
+    def __len__(self):
+        return len(self.schema.fields)
+    
+    def keys(self):
+        return list(self.schema.fields)
+    
+    def values(self):
+        return list(self._values)
+    
+    def items(self):
+        return zip(self.schema.fields, self._values)
+
+class _OffsetLines(object):
+    """Iterator of the lines of a file that tracks the byte offset of the 
+       next line
+    """
+    
+    def __init__(self, file_):
+        self.file = file_
+        self.offset = file_.tell()
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        line = self.file.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line
+    __next__ = next
+
 class CSVSource(object):
+    """ICachableSource of CSV rows
+    
+    Attributes:
+        compact_items: When True, items() generates CSVRecord items (instead
+                       of factory items with a dict of attributes per row), 
+                       which share the field names of their file.
+        index_lookups: When True (and the source is a file or directory 
+                       path), getById() and first() read rows straight from
+                       their byte offsets, found in an index of item keys to
+                       (file, offset).  The index is built during the first
+                       complete pass of items(), or by the first getById()
+                       (which then reads the files once).  first() reads the
+                       first row directly until the index is available.  The
+                       index is dropped once the modification times or sizes
+                       of the CSV files change.
+        index_file: String path of a sidecar file the index is saved to once
+                    built, and loaded from while the CSV files keep the 
+                    modification times and sizes they were indexed with.  
+                    When not set, the index is kept in memory only.
+        index_mmap: When True, indexed rows are read through a read-only 
+                    mmap of their file instead of seek() and readline().
+    """
     
     implements(ICachableSource)
     
@@ -39,18 +153,32 @@ class CSVSource(object):
         self._key = key
         self.source = source
         self.factory = factory
+        self.compact_items = False
+        self.index_lookups = False
+        self.index_file = None
+        self.index_mmap = False
         self._files = list()
+        self._paths = list()
         self._csv_dictreader_list = list()
+        self._index = None # key: (file number, byte offset)
+        self._index_fields = None # header field names of each file
+        self._index_first = None # (file number, byte offset) of first item
+        self._index_stats = None # _stats() of the indexed CSV files
+        self._lookup_handles = {}
+        self._lookup_schemas = {}
         
         if isinstance(source, str):
             if os.path.isfile(source):
                 _file = open(source,'rb')
                 self._files.append(_file)
+                self._paths.append(source)
                 self._csv_dictreader_list.append(DictReader(_file))
             elif os.path.isdir(source):
                 for _entry in os.listdir(source):
-                    _file = open(_entry,'rb')
+                    _path = os.path.join(source, _entry)
+                    _file = open(_path,'rb')
                     self._files.append(_file)
+                    self._paths.append(_path)
                     self._csv_dictreader_list.append(DictReader(_file))
             else:
                 raise ValueError("expected string source parameter to reference a valid file or directory: " + str(source))
@@ -72,21 +200,215 @@ class CSVSource(object):
         """Returns string identifier key that marks unique item entries (e.g. primary key field name)"""
         return self._key if self._key else self.factory().key
     
+    def fieldnames(self):
+        """Returns list of the header field names of the first CSV file (None
+           if it is empty), read without parsing any rows
+        """
+        if self._paths:
+            with open(self._paths[0], 'rb') as f:
+                for row in reader(f):
+                    return row
+            return None
+        return self._csv_dictreader_list[0].fieldnames
+    
     def items(self):
         """Returns a generator of available ICachableItem in the ICachableSource
         """
+        if self._indexing():
+            for item in self._indexed_items():
+                yield item
+            return
+        if self.compact_items:
+            for record in self._records():
+                yield record
+            return
         for dictreader in self._csv_dictreader_list:
             for entry in dictreader:
-                item = self.factory()
-                item.key = self.key()
-                item.attributes = entry
+                item = self._item(entry)
+                if item is not None:
+                    yield item
+    
+    def _item(self, entry):
+        """Returns validated factory item for DictReader entry or None"""
+        item = self.factory()
+        item.key = self.key()
+        item.attributes = entry
+        try:
+            item.validate()
+        except Exception as e:
+            logger.debug("skipping entry due to item validation exception: %s", str(e))
+            return None
+        logger.debug("found validated item in CSV source, key: %s", str(item.attributes[self.key()]))
+        return item
+    
+    def _record(self, schema, row):
+        """Returns validated CSVRecord for csv row or None"""
+        width = len(schema.fields)
+        if len(row) != width: # pad (or cut) to the header fields
+            row = (row + [None] * width)[:width]
+        record = CSVRecord(schema, tuple(row))
+        try:
+            record.validate()
+        except Exception as e:
+            logger.debug("skipping entry due to item validation exception: %s", str(e))
+            return None
+        return record
+    
+    def _records(self):
+        """Returns a generator of CSVRecord items for the valid CSV rows"""
+        for dictreader in self._csv_dictreader_list:
+            fields = dictreader.fieldnames
+            if fields is None: # empty
+                continue
+            schema = CSVRecordSchema(fields, self.key())
+            for row in dictreader.reader:
+                if not row:
+                    continue
+                record = self._record(schema, row)
+                if record is not None:
+                    yield record
+    
+    def _indexing(self):
+        """True if items() should build the lookup index"""
+        if not self.index_lookups or not self._paths or self._load_index():
+            return False
+        return all(f.tell() == 0 for f in self._files[:len(self._paths)])
+    
+    def _indexed_items(self):
+        """Returns a generator of the items of the CSV files that indexes 
+           their byte offsets, saving the index once all items are generated
+        """
+        index, fields, first, stats = {}, [], None, self._stats()
+        for file_no, _file in enumerate(self._files[:len(self._paths)]):
+            lines = _OffsetLines(_file)
+            dictreader = DictReader(lines)
+            self._csv_dictreader_list[file_no] = dictreader
+            fields.append(dictreader.fieldnames)
+            if fields[-1] is None: # empty
+                continue
+            schema = CSVRecordSchema(fields[-1], self.key())
+            while True:
+                offset = lines.offset
                 try:
-                    item.validate()
-                except Exception as e:
-                    logger.debug("skipping entry due to item validation exception: %s", str(e))
+                    if self.compact_items:
+                        row = next(dictreader.reader)
+                        if not row:
+                            continue
+                        item = self._record(schema, row)
+                    else:
+                        item = self._item(next(dictreader))
+                except StopIteration:
+                    break
+                if item is None:
                     continue
-                logger.debug("found validated item in CSV source, key: %s", str(item.attributes[self.key()]))
+                index.setdefault(item.getId(), (file_no, offset, ))
+                if first is None:
+                    first = (file_no, offset, )
                 yield item
+        self._index, self._index_fields, self._index_first = index, fields, first
+        self._index_stats = stats
+        logger.debug("indexed %d items of CSV source %s", len(index), self.source)
+        self._save_index()
+    
+    def _stats(self):
+        """Returns list of (path, modification time, size) of the CSV files"""
+        stats = []
+        for path in self._paths:
+            stat = os.stat(path)
+            stats.append((os.path.abspath(path), stat.st_mtime, stat.st_size, ))
+        return stats
+    
+    def _save_index(self):
+        if not self.index_file:
+            return
+        with open(self.index_file, 'wb') as f:
+            pickle.dump({'files': self._index_stats,
+                         'key': self.key(),
+                         'fields': self._index_fields,
+                         'first': self._index_first,
+                         'index': self._index}, f, pickle.HIGHEST_PROTOCOL)
+    
+    def _drop_index(self):
+        """Forgets the index and closes the lookup file handles"""
+        self._index = self._index_fields = self._index_first = None
+        self._index_stats = None
+        for handle in reversed(self._files[len(self._paths):]):
+            handle.close()
+        del self._files[len(self._paths):]
+        self._lookup_handles.clear()
+        self._lookup_schemas.clear()
+    
+    def _load_index(self):
+        """Loads the index from index_file if it matches the CSV files, 
+           returning True if the index is available
+        """
+        if self._index is not None:
+            if self._index_stats == self._stats():
+                return True
+            logger.debug("dropping out of date index of CSV source %s", self.source)
+            self._drop_index()
+        if not self.index_file or not os.path.isfile(self.index_file):
+            return False
+        try:
+            with open(self.index_file, 'rb') as f:
+                saved = pickle.load(f)
+        except Exception as e:
+            logger.debug("ignoring unreadable CSV index file %s: %s", self.index_file, str(e))
+            return False
+        if saved.get('files') != self._stats() or saved.get('key') != self.key():
+            logger.debug("ignoring out of date CSV index file %s", self.index_file)
+            return False
+        self._index, self._index_fields, self._index_first = \
+                            saved['index'], saved['fields'], saved['first']
+        self._index_stats = saved['files']
+        return True
+    
+    def _lookup_index(self):
+        """Returns True if lookups can use the index, building it if needed"""
+        if not self.index_lookups or not self._paths:
+            return False
+        if not self._load_index():
+            csvsource = self._copy()
+            for item in csvsource.items():
+                pass
+            self._index, self._index_fields, self._index_first = \
+                csvsource._index, csvsource._index_fields, csvsource._index_first
+            self._index_stats = csvsource._index_stats
+        return True
+    
+    def _read(self, location):
+        """Returns the item at (file number, byte offset) location"""
+        file_no, offset = location
+        handle = self._lookup_handles.get(file_no)
+        if handle is None:
+            handle = open(self._paths[file_no], 'rb')
+            self._files.append(handle)
+            if self.index_mmap:
+                handle = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+                self._files.append(handle)
+            self._lookup_handles[file_no] = handle
+        handle.seek(offset)
+        lines = iter(handle.readline, b'')
+        fields = self._index_fields[file_no]
+        if self.compact_items:
+            if file_no not in self._lookup_schemas:
+                self._lookup_schemas[file_no] = CSVRecordSchema(fields, self.key())
+            for row in reader(lines):
+                if row:
+                    return self._record(self._lookup_schemas[file_no], row)
+            return None
+        for entry in DictReader(lines, fieldnames=fields):
+            return self._item(entry)
+        return None
+    
+    def _copy(self):
+        """Returns new CSVSource with the same settings, to iterate separately"""
+        csvsource = CSVSource(self.source, self.factory, self.key())
+        csvsource.compact_items = self.compact_items
+        csvsource.index_lookups = self.index_lookups
+        csvsource.index_file = self.index_file
+        csvsource.index_mmap = self.index_mmap
+        return csvsource
     
     def getById(self, Id):
         """Returns ICachableItem that matches id
@@ -94,8 +416,11 @@ class CSVSource(object):
         Args:
             id: String that identifies the item to return whose key matches
         """
+        if self._lookup_index():
+            location = self._index.get(Id)
+            return self._read(location) if location is not None else None
         # we need to create a new object to insure we don't corrupt the generator count
-        csvsource = CSVSource(self.source, self.factory, self.key())
+        csvsource = self._copy()
         try:
             for item in csvsource.items():
                 if Id == item.getId():
@@ -105,8 +430,11 @@ class CSVSource(object):
     
     def first(self):
         """Returns the first ICachableItem in the ICachableSource"""
+        if self.index_lookups and self._paths and self._load_index():
+            return self._read(self._index_first) if self._index_first else None
         # we need to create a new object to insure we don't corrupt the generator count
-        csvsource = CSVSource(self.source, self.factory, self.key())
+        csvsource = self._copy()
+        csvsource.index_lookups = False # a single row does not build the index
         try:
             item = csvsource.items().next()
             return item
@@ -1,10 +1,20 @@
+import datetime
 import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing.dummy import Pool as ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
 from zope.component import adapts
 from zope.event import notify
 from zope.interface import implements
+from sparc.cache.bloom import BloomFilter
 from sparc.cache.events import CacheObjectCreatedEvent, CacheObjectModifiedEvent
 from sparc.cache import ICachableSource
-from sparc.cache import ITrimmableCacheArea
+from sparc.cache import ITrimmableCacheArea, ISweepableCacheArea
+from sparc.cache import IAgeableCachedItem
 import sparc.cache
 import sparc.db.splunk
 import sparc.utils.requests
@@ -13,9 +23,80 @@ from sparc.db.splunk.kvstore import current_kv_names
 from sparc.logging import logging
 logger = logging.getLogger(__name__)
 
+MAX_BATCH_SAVE = 1000 # Splunk's default max_documents_per_batch_save
+DEFAULT_PAGE_SIZE = 10000 # below Splunk's default max_rows_per_query
+MAX_DELETE_KEYS = 100 # keys per query delete, bounds the request URL length
+DEFAULT_FILTER_CAPACITY = 1000000
+_marker = object()
+
+def _chunks(iterable, size):
+    """Returns a generator of lists containing up to size entries of iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _timestamp(dt):
+    """Returns epoch seconds of naive local Python datetime dt"""
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+
 class CacheAreaForSplunkKV(object):
-    """An area where cached information can be stored persistently."""
-    implements(ITrimmableCacheArea)
+    """An area where cached information can be stored persistently.
+    
+    Attributes:
+        batch_size: Integer number of source items that import_source() and
+                    trim() will process at a time.  New and modified items 
+                    of each batch are written with a single request to the 
+                    collection's batch_save endpoint (which is limited to 
+                    MAX_BATCH_SAVE documents by default), and events are 
+                    then issued for each of them in source order.  When not
+                    set (the default), each item is written individually.
+        snapshot_imports: When True, import_source() and trim() first read
+                          the mapped fields of the entire collection, in 
+                          pages of page_size records, into a local index and
+                          then compare source items against that index 
+                          instead of requesting each item from Splunk.  Only
+                          new and modified items are then sent to Splunk.
+                          The index holds one tuple of values per cached item
+                          for the duration of the import.
+        page_size: Integer number of records to request at a time when 
+                   reading entire collections.
+        concurrency: Integer number of requests that import_source() and 
+                     trim() may have in flight at once for item lookups, 
+                     writes and deletes.  The requests are run by a pool of
+                     threads, while events are still issued in source order
+                     once the requests of each batch have completed.  When 
+                     the IRequest has a requester attribute (e.g. 
+                     sparc.utils.requests.Request), it is pointed at a 
+                     requests.Session shared by the threads, whose connection
+                     pool keeps up to concurrency connections alive for 
+                     re-use, until the import or trim returns.  Not set by 
+                     default.
+        id_filter: When True (and snapshot_imports is not set), 
+                   import_source() and trim() first read the collection's 
+                   ids, page_size at a time, into a 
+                   sparc.cache.bloom.BloomFilter.  Source items whose ids are
+                   not in the filter are known to be new, and are added 
+                   without being requested from Splunk first.
+        id_filter_capacity: Integer number of ids the filter is sized for.
+                            Beyond it, more items are needlessly requested.
+        id_filter_error_rate: Float rate of new items that are needlessly 
+                              requested (while within capacity).
+        expiration_field: String name of a collection field that stores the
+                          expiration of each written item, in epoch seconds,
+                          for sweep().  When expiration_age is set, items 
+                          expire expiration_age after they are written, 
+                          otherwise IAgeableCachedItem items expire at their
+                          expiration().  Declare the field as a number in 
+                          the collection schema (e.g. 'field.expires': 
+                          'number'), ideally with an accelerated field 
+                          (e.g. 'accelerated_fields.expires': '{"expires": 1}').
+                          Not set by default.
+        expiration_age: Python timedelta after which written items expire.
+    """
+    implements(ITrimmableCacheArea, ISweepableCacheArea)
     adapts(sparc.cache.ICachedItemMapper,
            sparc.db.splunk.ISplunkKVCollectionSchema,
            sparc.db.splunk.ISplunkConnectionInfo,
@@ -35,6 +116,18 @@ class CacheAreaForSplunkKV(object):
             request: Object providing sparc.utils.requests.IRequest
         """
         self.gooble_request_warnings = False
+        self.batch_size = 0
+        self.snapshot_imports = False
+        self.page_size = DEFAULT_PAGE_SIZE
+        self.concurrency = 0
+        self.id_filter = False
+        self.id_filter_capacity = DEFAULT_FILTER_CAPACITY
+        self.id_filter_error_rate = 0.01
+        self.expiration_field = None
+        self.expiration_age = None
+        self._pool = None
+        self._http_session = None
+        self._http_pool_size = 0
         self.mapper = mapper
         self.schema = schema
         self.sci = sci
@@ -54,12 +147,68 @@ class CacheAreaForSplunkKV(object):
     
     def request(self, *args, **kwargs):
         return self._request.request(*args, **kwargs)
+    
+    def _pooled_session(self):
+        """Points the IRequest requester to a shared requests.Session whose
+           connection pool can hold concurrency connections, returning the 
+           previous requester (or _marker if the IRequest has none)
+        """
+        if not hasattr(self._request, 'requester'):
+            return _marker
+        requester = self._request.requester
+        if self._http_session is None:
+            self._http_session = requests.Session()
+        if self._http_pool_size < self.concurrency:
+            self._http_session.mount('https://', 
+                        HTTPAdapter(pool_maxsize=self.concurrency))
+            self._http_pool_size = self.concurrency
+        self._request.requester = self._http_session
+        return requester
+    
+    @contextmanager
+    def _workers(self):
+        """Runs the block with a pool of concurrency threads available to 
+           _map(), if concurrency is set
+        """
+        if self._pool is not None or self.concurrency < 2:
+            yield
+            return
+        requester = self._pooled_session()
+        self._pool = ThreadPool(self.concurrency)
+        try:
+            yield
+        finally:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            if requester is not _marker:
+                self._request.requester = requester
+    
+    def _map(self, func, iterable):
+        """Returns list of func results for each entry of iterable, in order,
+           running them with the worker pool when available (see _workers())
+        """
+        if self._pool is None:
+            return [func(entry) for entry in iterable]
+        return self._pool.map(func, iterable)
 
     def _data(self, CachedItem):
         data = {k:getattr(CachedItem, k) for k in self.mapper.mapper}
         data['_key'] = CachedItem.getId()
+        if self.expiration_field:
+            expiration = self._expiration(CachedItem)
+            if expiration is not None:
+                data[self.expiration_field] = expiration
         return data
     
+    def _expiration(self, CachedItem):
+        """Returns epoch seconds CachedItem expires at or None if it does not"""
+        if self.expiration_age:
+            return _timestamp(datetime.datetime.now() + self.expiration_age)
+        if IAgeableCachedItem.providedBy(CachedItem):
+            return _timestamp(CachedItem.expiration())
+        return None
+    
     def _add(self, CachedItem):
         r = self.request('post',
                          self.url+"storage/collections/data/"+self.collname, 
@@ -74,6 +223,13 @@ class CacheAreaForSplunkKV(object):
             data=json.dumps(self._data(CachedItem)))
         r.raise_for_status()
     
+    def _batch_save(self, CachedItems):
+        r = self.request('post',
+            self.url+"storage/collections/data/"+self.collname+'/batch_save',
+            headers={'Content-Type': 'application/json'}, 
+            data=json.dumps([self._data(item) for item in CachedItems]))
+        r.raise_for_status()
+    
     def _delete(self, id_):
         if not id_:
             raise ValueError("Expected valid id for deletion")
@@ -81,14 +237,74 @@ class CacheAreaForSplunkKV(object):
                 self.url+"storage/collections/data/"+self.collname+'/'+str(id_))
         r.raise_for_status()
 
-    def _all_ids(self):
-        r = self.request('get',
-                         self.url+"storage/collections/data/"+self.collname,
-                         headers={'Content-Type': 'application/json'}, 
-                         params={'output_type': 'json', 'fields':'id'})
+    def _pages(self, fields):
+        """Returns generator of lists of collection records, with only the 
+           given fields (and _key), of up to page_size records in _key order
+        
+        Each page is requested for the keys following the last key of the 
+        previous page (rather than with a skip offset), so records deleted
+        from the pages already returned do not shift the following pages.
+        """
+        fields = list(fields) + (['_key'] if '_key' not in fields else [])
+        params = {'output_mode': 'json', 
+                  'fields': ','.join(fields),
+                  'sort': '_key',
+                  'limit': self.page_size}
+        while True:
+            r = self.request('get',
+                             self.url+"storage/collections/data/"+self.collname,
+                             headers={'Content-Type': 'application/json'}, 
+                             params=params)
+            r.raise_for_status()
+            page = r.json()
+            if page:
+                yield page
+            if len(page) < self.page_size:
+                return
+            params['query'] = json.dumps({'_key': {'$gt': page[-1]['_key']}})
+    
+    def _snapshot_names(self):
+        return sorted(self.mapper.mapper)
+    
+    def _snapshot(self):
+        """Returns dict of cached item ids to tuples of mapped field values
+           (see _snapshot_names())
+        """
+        names = self._snapshot_names()
+        snapshot = {}
+        for page in self._pages(names):
+            for data in page:
+                snapshot[data['_key']] = tuple(data.get(name) for name in names)
+        logger.debug("read snapshot of %d items from Splunk KV collection %s", len(snapshot), self.collname)
+        return snapshot
+    
+    def _delete_many(self, ids):
+        """Deletes the items with the given ids with a single query request"""
+        if not all(ids):
+            raise ValueError("Expected valid ids for deletion")
+        # Splunk KV queries have no $in operator
+        r = self.request('delete', 
+                self.url+"storage/collections/data/"+self.collname,
+                params={'query': json.dumps({'$or': [{'_key': str(id_)} for id_ in ids]})})
         r.raise_for_status()
-        data = set(map(lambda d: str(d['id']), r.json()))
-        return data
+    
+    def _iter_ids(self):
+        """Returns generator of the cached item ids, in sorted order, 
+           requested page_size ids at a time
+        """
+        for page in self._pages(['_key']):
+            for d in page:
+                yield str(d['_key'])
+    
+    def _all_ids(self):
+        return set(self._iter_ids())
+    
+    def _id_filter(self):
+        """Returns BloomFilter of the cached item ids (see id_filter)"""
+        known = BloomFilter(self.id_filter_capacity, self.id_filter_error_rate)
+        known.update(self._iter_ids())
+        logger.debug("read %d ids from Splunk KV collection %s into filter", known.count, self.collname)
+        return known
 
     #ICacheArea
     def get(self, CachableItem):
@@ -143,11 +359,113 @@ class CacheAreaForSplunkKV(object):
         """
         _count = 0
         self._import_source_items_id_list = set() # used to help speed up trim()
+        if self.batch_size or self.snapshot_imports or self.id_filter or \
+                                                        self.concurrency > 1:
+            with self._workers():
+                snapshot = known = None
+                if self.snapshot_imports:
+                    snapshot = self._snapshot()
+                elif self.id_filter:
+                    known = self._id_filter()
+                for items in _chunks(CachableSource.items(), 
+                                     self.batch_size or self.page_size):
+                    self._import_source_items_id_list.update(
+                                                item.getId() for item in items)
+                    _count += self._import_items(items, snapshot, known)
+            return _count
         for item in CachableSource.items():
             self._import_source_items_id_list.add(item.getId())
             if self.cache(item):
                 _count += 1
         return _count
+    
+    def _write(self, change):
+        """Writes (ICachedItem, event class) change with a single request"""
+        _item, _event = change
+        if _event is CacheObjectCreatedEvent:
+            self._add(_item)
+        else:
+            self._update(_item)
+    
+    def _lookup(self, CachableItems, snapshot=None, known=None):
+        """Returns list of (new ICachedItem, current ICachedItem or None) 
+           for each ICachableItem
+        
+        Current items are looked up in snapshot (see _snapshot()) if given,
+        otherwise they are requested from Splunk, skipping items whose ids
+        are not in the known BloomFilter if given.
+        """
+        if snapshot is None:
+            _newCacheItems = [self.mapper.get(item) for item in CachableItems]
+            _cachedItems = [None] * len(_newCacheItems)
+            _indexes = [i for i, _item in enumerate(_newCacheItems) 
+                                if known is None or str(_item.getId()) in known]
+            for i, _cachedItem in zip(_indexes, self._map(self.get, 
+                                    [CachableItems[i] for i in _indexes])):
+                _cachedItems[i] = _cachedItem
+            return zip(_newCacheItems, _cachedItems)
+        names = self._snapshot_names()
+        pairs = []
+        for item in CachableItems:
+            _newCacheItem = self.mapper.get(item)
+            values = snapshot.get(_newCacheItem.getId())
+            _cachedItem = None
+            if values is not None:
+                _cachedItem = self.mapper.get(item)
+                for name, value in zip(names, values):
+                    setattr(_cachedItem, name, value)
+            pairs.append((_newCacheItem, _cachedItem, ))
+        return pairs
+    
+    def _import_items(self, CachableItems, snapshot=None, known=None):
+        """Caches ICachableItems returning number of items that required 
+           updates
+        
+        Items are written with batch_save requests when batch_size is set.  
+        An item id that repeats within CachableItems is written once, with
+        its last values, but like item by item imports, every occurrence
+        that differs from the previous one is counted and gets an event (the
+        first a created event if the id is new, the others modified events).
+        snapshot and known are updated with the written items (see 
+        _lookup()).
+        """
+        _changes = OrderedDict() # id: (ICachedItem, event class)
+        _events = [] # (ICachedItem, event class)
+        for _newCacheItem, _cachedItem in self._lookup(CachableItems, snapshot, known):
+            _id = _newCacheItem.getId()
+            if _id in _changes:
+                _pending, _event = _changes[_id]
+                if _pending == _newCacheItem:
+                    continue
+                _changes[_id] = (_newCacheItem, _event or CacheObjectModifiedEvent, )
+                _event = CacheObjectModifiedEvent
+            elif _cachedItem is None:
+                _event = CacheObjectCreatedEvent
+                _changes[_id] = (_newCacheItem, _event, )
+            elif _cachedItem != _newCacheItem:
+                _event = CacheObjectModifiedEvent
+                _changes[_id] = (_newCacheItem, _event, )
+            else:
+                _changes[_id] = (_newCacheItem, None, ) # unchanged, not written
+                continue
+            _events.append((_newCacheItem, _event, ))
+        _changes = [_change for _change in _changes.values() if _change[1] is not None]
+        if self.batch_size:
+            for _batch in _chunks(_changes, MAX_BATCH_SAVE):
+                self._batch_save([_item for _item, _event in _batch])
+        else:
+            self._map(self._write, _changes)
+        if snapshot is not None:
+            names = self._snapshot_names()
+            for _item, _event in _changes:
+                snapshot[_item.getId()] = tuple(getattr(_item, name) for name in names)
+        if known is not None:
+            known.update(str(_item.getId()) for _item, _event in _changes
+                                        if _event is CacheObjectCreatedEvent)
+        for _item, _event in _events:
+            logger.debug("cachable item saved to Splunk KV cache area {id: %s, type: %s}", str(_item.getId()), str(_item.__class__))
+            notify(_event(_item, self))
+        return len(_events)
 
     def reset(self):
         """Deletes all entries in the cache area"""
@@ -180,14 +498,46 @@ class CacheAreaForSplunkKV(object):
     
     #ITrimmableCacheArea
     def trim(self, source):
+        """Imports source, then removes cached items not found in source
+        
+        The collection ids are read page by page and stale items are removed
+        as they are found, with query deletes of up to MAX_DELETE_KEYS keys 
+        each.  Returns tuple of (updated count, removed count), where removed
+        counts the stale items listed in the collection (a failed delete 
+        request raises).
+        """
         if not ICachableSource.providedBy(source):
             #we'll fake a partial ICachableSource for use with import_source()
             source_type = type('FakeCachableSource', (object,), {})
             _source = source #re-assign due to closure issue with source re-assignment below
             source_type.items = lambda self: _source
             source = source_type()
-        updated = self.import_source(source)
-        diff = self._all_ids() - self._import_source_items_id_list
-        map(self._delete, diff)
-        return (updated, len(diff), )
+        removed = 0
+        with self._workers():
+            updated = self.import_source(source)
+            stale = (id_ for id_ in self._iter_ids() 
+                            if id_ not in self._import_source_items_id_list)
+            for ids in _chunks(stale, MAX_DELETE_KEYS * max(self.concurrency, 1)):
+                self._map(self._delete_many, list(_chunks(ids, MAX_DELETE_KEYS)))
+                removed += len(ids)
+        logger.debug("trimmed %d items from Splunk KV collection %s", removed, self.collname)
+        return (updated, removed, )
+    
+    #ISweepableCacheArea
+    def sweep(self, now=None):
+        """Removes items whose expiration_field is before now with a single 
+           query delete request
+        
+        Nothing is removed when expiration_field is not set.  Returns None,
+        as Splunk does not report the number of deleted records.
+        """
+        if not self.expiration_field:
+            return None
+        now = _timestamp(now or datetime.datetime.now())
+        r = self.request('delete', 
+                self.url+"storage/collections/data/"+self.collname,
+                params={'query': json.dumps({self.expiration_field: {'$lt': now}})})
+        r.raise_for_status()
+        logger.debug("swept items expired before %s from Splunk KV collection %s", str(now), self.collname)
+        return None
 
@@ -0,0 +1,119 @@
+"""Request volume and throughput benchmark for CacheAreaForSplunkKV
+
+Runs import, trim and reset against a local SplunkKVStandIn (see testing.py)
+and reports requests per item, items per second and bytes transferred for
+each.  Run with python -m sparc.cache.splunk.benchmark --help for options.
+"""
+import argparse
+import sys
+import time
+from zope.interface import implements
+from sparc.cache import ICachableSource
+from sparc.cache.item import SimpleItemMapper, cachableItemMixin
+from sparc.cache.splunk.area import CacheAreaForSplunkKV
+from sparc.cache.splunk.testing import SplunkKVStandIn, StandInRequest
+
+SCHEMA = {'field.id': 'string', 'field.name': 'string'}
+
+class _CollectionIdentifier(object):
+    def __init__(self, collection, application=u'search', username=u'nobody'):
+        self.collection = collection
+        self.application = application
+        self.username = username
+
+class _ListSource(object):
+    implements(ICachableSource)
+    def __init__(self, items):
+        self._items = items
+    def items(self):
+        return iter(self._items)
+
+def cachable_item(id_, name):
+    return cachableItemMixin('id', {'id': id_, 'name': name})
+
+def cache_area(standin, collection=u'benchmark', **settings):
+    """Returns initialized CacheAreaForSplunkKV for standin collection with
+       the given attribute settings (e.g. batch_size=500)
+    """
+    mapper = SimpleItemMapper('id', cachable_item(None, None))
+    area = CacheAreaForSplunkKV(mapper, SCHEMA, standin.sci,
+                                _CollectionIdentifier(collection),
+                                StandInRequest())
+    for name, value in settings.items():
+        setattr(area, name, value)
+    area.initialize()
+    return area
+
+def _measure(standin, name, items, call):
+    standin.reset_stats()
+    start = time.time()
+    call()
+    seconds = max(time.time() - start, 1e-6)
+    stats = dict(standin.stats)
+    return {'phase': name,
+            'items': items,
+            'seconds': seconds,
+            'requests': stats['requests'],
+            'requests_per_item': float(stats['requests']) / items,
+            'items_per_second': items / seconds,
+            'bytes_sent': stats['bytes_received'],
+            'bytes_received': stats['bytes_sent']}
+
+def benchmark(standin, area, count=1000):
+    """Returns list of result dicts for import, re-import, trim and reset
+       phases run with area against standin
+
+    The import phase caches count new items, re-import caches the same
+    items again, and trim caches a source where a tenth of the items are
+    modified and a tenth are missing.  Result dicts hold phase, items,
+    seconds, requests, requests_per_item, items_per_second, bytes_sent and
+    bytes_received (from the client's point of view).
+    """
+    items = [cachable_item(str(i), u'name %d' % i) for i in range(count)]
+    trimmed = [cachable_item(str(i), u'new name %d' % i) if i % 10 == 1
+                                                    else items[i]
+                                for i in range(count) if i % 10]
+    return [
+        _measure(standin, 'import', count,
+                 lambda: area.import_source(_ListSource(items))),
+        _measure(standin, 're-import', count,
+                 lambda: area.import_source(_ListSource(items))),
+        _measure(standin, 'trim', count,
+                 lambda: area.trim(_ListSource(trimmed))),
+        _measure(standin, 'reset', len(trimmed), area.reset)]
+
+def report(results):
+    """Returns string table of benchmark() results"""
+    lines = ['%-10s %8s %9s %9s %10s %12s %12s' % ('phase', 'items',
+                'requests', 'req/item', 'items/sec', 'bytes sent', 'bytes recv')]
+    for r in results:
+        lines.append('%-10s %8d %9d %9.3f %10.1f %12d %12d' % (r['phase'],
+                r['items'], r['requests'], r['requests_per_item'],
+                r['items_per_second'], r['bytes_sent'], r['bytes_received']))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=0)
+    parser.add_argument('--snapshot', action='store_true')
+    parser.add_argument('--id-filter', action='store_true')
+    parser.add_argument('--page-size', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, default=0)
+    args = parser.parse_args(argv)
+    settings = {'batch_size': args.batch_size,
+                'snapshot_imports': args.snapshot,
+                'id_filter': args.id_filter,
+                'concurrency': args.concurrency}
+    if args.page_size:
+        settings['page_size'] = args.page_size
+    standin = SplunkKVStandIn()
+    standin.start()
+    try:
+        area = cache_area(standin, **settings)
+        print(report(benchmark(standin, area, args.items)))
+    finally:
+        standin.stop()
+
+if __name__ == '__main__':
+    sys.exit(main())
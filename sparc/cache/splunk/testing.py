@@ -0,0 +1,364 @@
+"""Local stand-in for the Splunk KV store REST endpoints
+
+SplunkKVStandIn serves the storage/collections/config and
+storage/collections/data endpoints used by CacheAreaForSplunkKV from memory,
+over https on a local port.  It counts the requests and bytes it handles so
+request volume can be measured offline (see benchmark.py).
+"""
+import json
+import os.path
+from itertools import count
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+from zope.interface import implements
+import requests
+import sparc.utils.requests
+
+from sparc.logging import logging
+logger = logging.getLogger(__name__)
+
+def _matches(record, query):
+    """True if record dict matches Splunk KV query dict"""
+    for name, condition in query.items():
+        if name == '$or':
+            if not any(_matches(record, q) for q in condition):
+                return False
+        elif name == '$and':
+            if not all(_matches(record, q) for q in condition):
+                return False
+        elif name == '$not':
+            if _matches(record, condition):
+                return False
+        elif isinstance(condition, dict):
+            value = record.get(name)
+            for operator, operand in condition.items():
+                if operator == '$ne':
+                    if value == operand:
+                        return False
+                    continue
+                if value is None:
+                    return False
+                if operator == '$gt' and not value > operand or \
+                   operator == '$gte' and not value >= operand or \
+                   operator == '$lt' and not value < operand or \
+                   operator == '$lte' and not value <= operand:
+                    return False
+        elif record.get(name) != condition:
+            return False
+    return True
+
+class _CountingFile(object):
+    """File wrapper that adds the number of bytes read or written to stats"""
+
+    def __init__(self, file_, stats, name):
+        self._file = file_
+        self._stats = stats
+        self._name = name
+
+    def _count(self, data):
+        with self._stats['lock']:
+            self._stats[self._name] += len(data)
+        return data
+
+    def read(self, *args):
+        return self._count(self._file.read(*args))
+
+    def readline(self, *args):
+        return self._count(self._file.readline(*args))
+
+    def write(self, data):
+        self._count(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+class _KVRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+    wbufsize = -1 # send each response with as few writes as possible...
+    disable_nagle_algorithm = True # ...and without delay
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.rfile = _CountingFile(self.rfile, self.server.stats, 'bytes_received')
+        self.wfile = _CountingFile(self.wfile, self.server.stats, 'bytes_sent')
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _respond(self, status, body=None):
+        content = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _not_found(self):
+        self._respond(404, {'messages': [{'type': 'ERROR',
+                                          'text': 'Could not find object.'}]})
+
+    def _handle(self, method):
+        with self.server.stats['lock']:
+            self.server.stats['requests'] += 1
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        path = [unquote(p) for p in url.path.split('/') if p]
+        # /servicesNS/<user>/<app>/storage/collections/<config|data>/...
+        if len(path) < 6 or path[3:5] != ['storage', 'collections']:
+            return self._not_found()
+        with self.server.lock:
+            if path[5] == 'config':
+                return self._config(method, path[6:], params, body)
+            if path[5] == 'data' and len(path) > 6:
+                return self._data(method, path[6], path[7:], params, body)
+        return self._not_found()
+
+    def _config(self, method, path, params, body):
+        collections = self.server.collections
+        if not path:
+            if method == 'GET':
+                if params.get('output_mode') == 'json':
+                    return self._respond(200, {'entry': [
+                        {'name': name, 'content': self.server.schemas[name]}
+                                            for name in sorted(collections)]})
+                content = ''.join('<entry><title>%s</title></entry>' % name
+                                            for name in sorted(collections))
+                content = ('<feed xmlns="http://www.w3.org/2005/Atom">%s</feed>'
+                                                    % content).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/xml')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                return self.wfile.write(content)
+            if method == 'POST':
+                name = parse_qs(body.decode('utf-8'))['name'][-1]
+                if name in collections:
+                    return self._respond(409, {})
+                collections[name] = {}
+                self.server.schemas[name] = {}
+                return self._respond(201, {})
+        elif path[0] in collections:
+            name = path[0]
+            if method == 'GET':
+                return self._respond(200, {'entry': [
+                    {'name': name, 'content': self.server.schemas[name]}]})
+            if method == 'POST':
+                self.server.schemas[name].update(
+                    {k: v[-1] for k, v in parse_qs(body.decode('utf-8')).items()})
+                return self._respond(200, {})
+            if method == 'DELETE':
+                del collections[name]
+                del self.server.schemas[name]
+                return self._respond(200, {})
+        return self._not_found()
+
+    def _key(self, record):
+        """Returns record's string _key, assigning a new one if missing"""
+        key = record.get('_key')
+        record['_key'] = u'%s' % (key if key is not None else self.server.next_key())
+        return record['_key']
+
+    def _data(self, method, name, path, params, body):
+        collection = self.server.collections.get(name)
+        if collection is None:
+            return self._not_found()
+        if not path:
+            if method == 'GET':
+                return self._respond(200, self._query(collection, params))
+            if method == 'POST':
+                record = json.loads(body.decode('utf-8'))
+                key = self._key(record)
+                if key in collection:
+                    return self._respond(409, {})
+                collection[key] = record
+                return self._respond(201, {'_key': key})
+            if method == 'DELETE':
+                query = json.loads(params.get('query', '{}'))
+                for key in [k for k, r in collection.items() if _matches(r, query)]:
+                    del collection[key]
+                return self._respond(200)
+        elif path[0] == 'batch_save' and method == 'POST':
+            records = json.loads(body.decode('utf-8'))
+            if len(records) > self.server.max_batch_save:
+                return self._respond(400, {})
+            for record in records:
+                collection[self._key(record)] = record
+            return self._respond(200, [record['_key'] for record in records])
+        else:
+            key = path[0]
+            if method == 'POST':
+                record = json.loads(body.decode('utf-8'))
+                record['_key'] = key
+                collection[key] = record
+                return self._respond(200, {'_key': key})
+            if key not in collection:
+                return self._not_found()
+            if method == 'GET':
+                return self._respond(200, collection[key])
+            if method == 'DELETE':
+                del collection[key]
+                return self._respond(200)
+        return self._not_found()
+
+    def _query(self, collection, params):
+        records = list(collection.values())
+        if 'query' in params:
+            query = json.loads(params['query'])
+            records = [r for r in records if _matches(r, query)]
+        for sort in reversed(params.get('sort', '_key').split(',')):
+            field, _, direction = sort.partition(':')
+            records = sorted(records, key=lambda r: r.get(field),
+                             reverse=direction == '-1')
+        skip = int(params.get('skip', 0))
+        limit = int(params.get('limit', 0))
+        records = records[skip:skip + limit] if limit else records[skip:]
+        if 'fields' in params:
+            fields = params['fields'].split(',') + ['_key']
+            records = [{k: r[k] for k in fields if k in r} for r in records]
+        return records
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # typically clients closing kept-alive connections
+        logger.debug("error handling request from %s", client_address, exc_info=True)
+
+class SplunkKVStandIn(object):
+    """Local https stand-in for the Splunk KV store REST endpoints
+
+    Collections are held in memory.  The config endpoints create, describe
+    and delete collections, and the data endpoints support record get,
+    insert, update and delete, batch_save, and query deletes plus query,
+    fields, sort, skip and limit parameters when listing records.
+
+    Attributes:
+        sci: connection information dict for the stand-in (host, port,
+             username, password)
+        collections: dict of collection names to dicts of _key: record
+        stats: dict with the number of requests, bytes_received and
+               bytes_sent handled since start() or the last reset_stats()
+        max_batch_save: maximum number of documents accepted by batch_save
+        certfile: path of a PEM file with the certificate and private key to
+                  serve https with.  When not set, start() generates a 
+                  throwaway self-signed certificate with the openssl command,
+                  which is removed by stop().
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        """Initialize the stand-in, port 0 selects a free port on start()"""
+        self.host = host
+        self.port = port
+        self.collections = {}
+        self.max_batch_save = 1000
+        self.certfile = None
+        self._certdir = None
+        self._server = None
+        self._thread = None
+        self.stats = {'lock': threading.Lock()}
+        self.reset_stats()
+
+    @property
+    def sci(self):
+        return {'host': self.host, 'port': str(self.port),
+                'username': 'admin', 'password': 'changeme'}
+
+    def reset_stats(self):
+        with self.stats['lock']:
+            self.stats.update({'requests': 0, 'bytes_received': 0, 'bytes_sent': 0})
+
+    def _certificate(self):
+        """Returns path of the PEM file to serve https with"""
+        if self.certfile:
+            return self.certfile
+        self._certdir = tempfile.mkdtemp()
+        key, cert = [os.path.join(self._certdir, name) for name in ('key.pem', 'cert.pem')]
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 
+                    'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-keyout', key, '-out', cert], stdout=devnull, stderr=devnull)
+        except (OSError, subprocess.CalledProcessError) as e:
+            self._remove_certificate()
+            raise RuntimeError("unable to generate a certificate for the Splunk KV stand-in with openssl (set certfile instead): %s" % str(e))
+        with open(cert, 'ab') as f, open(key, 'rb') as k:
+            f.write(k.read())
+        return cert
+
+    def _remove_certificate(self):
+        if self._certdir:
+            shutil.rmtree(self._certdir, ignore_errors=True)
+            self._certdir = None
+
+    def start(self):
+        """Starts serving requests in a background thread"""
+        server = _ThreadingHTTPServer((self.host, self.port), _KVRequestHandler)
+        try:
+            server.socket = ssl.wrap_socket(server.socket, 
+                                certfile=self._certificate(), server_side=True)
+        except Exception:
+            server.server_close()
+            self._remove_certificate()
+            raise
+        server.collections = self.collections
+        server.schemas = {}
+        server.stats = self.stats
+        server.lock = threading.Lock()
+        server.max_batch_save = self.max_batch_save
+        keys = count(1)
+        server.next_key = lambda: next(keys)
+        self.port = server.server_address[1]
+        self._server = server
+        self._thread = threading.Thread(target=server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        logger.debug("started Splunk KV stand-in on port %d", self.port)
+
+    def stop(self):
+        """Stops serving requests"""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = self._thread = None
+        self._remove_certificate()
+
+class StandInRequest(object):
+    """sparc.utils.requests.IRequest for use with SplunkKVStandIn
+
+    Requests are sent with a requests.Session (see requester), without
+    verifying the stand-in's self-signed certificate.
+    """
+    implements(sparc.utils.requests.IRequest)
+
+    def __init__(self):
+        self.requester = requests.Session()
+        self.req_kwargs = {'verify': False}
+
+    def request(self, *args, **kwargs):
+        _kwargs = dict(self.req_kwargs)
+        _kwargs.update(kwargs)
+        return self.requester.request(*args, **_kwargs)
@@ -1,3 +1,4 @@
+import datetime
 import os
 import unittest
 import zope.testrunner
@@ -184,6 +185,90 @@ class SparcCacheSplunkAreaTestCase(unittest.TestCase):
         self.assertEquals(counts, (1,1,))
         self.assertTrue(self.cache_area.isDirty(trimmed))
         self.assertFalse(self.cache_area.isDirty(popped))
+    
+    def test_batched_import_source_and_trim(self):
+        self.cache_area.batch_size = 1
+        count = self.cache_area.import_source(self.get_cachable_source())
+        self.assertEquals(count, 2)
+        self.assertEquals(self.cache_area._all_ids(), set(['abc','123']))
+        self.assertEquals(len(getEvents(ICacheObjectCreatedEvent)), 2)
+        self.assertEquals(getEvents(ICacheObjectModifiedEvent), [])
+        
+        cs = self.get_cachable_source()
+        cs._items[0].attributes['name'] = 'another name'
+        popped = cs._items.pop()
+        counts = self.cache_area.trim(cs)
+        self.assertEquals(counts, (1,1,))
+        self.assertEquals(len(getEvents(ICacheObjectModifiedEvent)), 1)
+        self.assertTrue(self.cache_area.isDirty(popped))
+        self.assertFalse(self.cache_area.isDirty(cs._items[0]))
+    
+    def test_batched_import_source_repeated_ids(self):
+        self.cache_area.batch_size = 10
+        cs = self.get_cachable_source()
+        cs._items.append(self.cachable_item('123', 'name 1'))
+        cs._items.append(self.cachable_item('123', 'another name'))
+        count = self.cache_area.import_source(cs)
+        self.assertEquals(count, 3) # like item by item imports
+        self.assertEquals(len(getEvents(ICacheObjectCreatedEvent)), 2)
+        self.assertEquals(len(getEvents(ICacheObjectModifiedEvent)), 1)
+        self.assertFalse(self.cache_area.isDirty(cs._items[-1]))
+    
+    def test_snapshot_import_source(self):
+        self.cache_area.snapshot_imports = True
+        self.cache_area.page_size = 1
+        count = self.cache_area.import_source(self.get_cachable_source())
+        self.assertEquals(count, 2)
+        self.assertEquals(self.cache_area._snapshot(), 
+                          {'123': ('123', 'name 1'), 'abc': ('abc', 'name 2')})
+        self.assertEquals(self.cache_area.import_source(self.get_cachable_source()), 0)
+        
+        cs = self.get_cachable_source()
+        cs._items[1].attributes['name'] = 'another name'
+        self.assertEquals(self.cache_area.import_source(cs), 1)
+        self.assertEquals(len(getEvents(ICacheObjectCreatedEvent)), 2)
+        self.assertEquals(len(getEvents(ICacheObjectModifiedEvent)), 1)
+        self.assertFalse(self.cache_area.isDirty(cs._items[1]))
+    
+    def test_paged_ids_and_trim(self):
+        self.cache_area.page_size = 1
+        cs = self.get_cachable_source()
+        cs._items.extend([self.cachable_item(str(i), 'name') for i in range(5)])
+        self.cache_area.import_source(cs)
+        self.assertEquals(list(self.cache_area._iter_ids()), 
+                          sorted(str(item.getId()) for item in cs._items))
+        
+        counts = self.cache_area.trim(cs._items[::2])
+        self.assertEquals(counts, (0,3,))
+        self.assertEquals(self.cache_area._all_ids(), 
+                          set(str(item.getId()) for item in cs._items[::2]))
+    
+    def test_concurrent_import_source_and_trim(self):
+        self.cache_area.concurrency = 4
+        requester = getattr(self.cache_area._request, 'requester', None)
+        cs = self.get_cachable_source()
+        cs._items.extend([self.cachable_item(str(i), 'name') for i in range(10)])
+        count = self.cache_area.import_source(cs)
+        self.assertEquals(count, 12)
+        self.assertIs(getattr(self.cache_area._request, 'requester', None), requester)
+        self.assertEquals([e.object.getId() for e in getEvents(ICacheObjectCreatedEvent)],
+                          [item.getId() for item in cs._items])
+        
+        popped = cs._items.pop()
+        counts = self.cache_area.trim(cs)
+        self.assertEquals(counts, (0,1,))
+        self.assertTrue(self.cache_area.isDirty(popped))
+        self.assertEquals(len(self.cache_area._all_ids()), 11)
+    
+    def test_sweep(self):
+        self.assertEquals(self.cache_area.sweep(), None) # no expiration_field
+        self.cache_area.expiration_field = 'expires'
+        self.cache_area.expiration_age = datetime.timedelta(hours=1)
+        self.cache_area.import_source(self.get_cachable_source())
+        self.cache_area.sweep()
+        self.assertEquals(self.cache_area._all_ids(), set(['abc','123']))
+        self.cache_area.sweep(datetime.datetime.now() + datetime.timedelta(hours=2))
+        self.assertEquals(self.cache_area._all_ids(), set())
 
 # this will insure the doc test clean-up will happen for the created KV collections
 kv_names['type1'] = {}
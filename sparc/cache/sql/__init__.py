@@ -1,2 +1,3 @@
 from .sql import SqlObjectCacheArea
-from .sql import SqlObjectMapperMixin
\ No newline at end of file
+from .sql import SqlObjectMapperMixin
+from .sql import SqlObjectCacheAreaSource
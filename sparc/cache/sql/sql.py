@@ -3,31 +3,72 @@ from zope.component.factory import IFactory
 from zope.component import adapts, queryAdapter
 from zope.event import notify
 from sqlalchemy.orm import Session
-from datetime import date
+from collections import OrderedDict
+from datetime import date, datetime
+from importlib import import_module
+from itertools import islice
+import threading
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 import sqlalchemy.orm
 import sqlalchemy.ext.declarative
 
 from sparc.configuration.zcml import ConfigurationRequired
-from sparc.cache import ICacheArea, ITransactionalCacheArea, ICachableSource, ICachableItem, ICachedItem
+from sparc.cache import ICacheArea, ITransactionalCacheArea, ITrimmableCacheArea, ISweepableCacheArea, ICachableSource, ICachableItem, ICachedItem
 from sparc.cache import ICachedItemMapper, IManagedCachedItemMapperAttribute, IManagedCachedItemMapperAttributeKeyWrapper
 from sparc.cache.events import CacheObjectCreatedEvent, CacheObjectModifiedEvent
+from sparc.cache.item import cachableItemMixin, values_digest
 from sparc.db.sql.sa import ISqlAlchemySession, ISqlAlchemyDeclarativeBase
 
 from sparc.logging import logging
 logger = logging.getLogger(__name__)
 
+DEFAULT_BATCH_SIZE = 500
+TRUNCATE_DIALECTS = ('postgresql', 'mysql', 'mssql', 'oracle', )
+_marker = object()
+
+def chunks(iterable, size):
+    """Returns a generator of lists containing up to size entries of iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+def _unicode(value):
+    return value.decode('utf8', 'replace') if value else None
+
+def _manager(managed):
+    """Returns converter callable for IManagedCachedItemMapperAttribute"""
+    return lambda value: managed.manage(value) if value else None
+
 class SqlObjectMapperMixin(object):
     """Base class for ICachedItemMapper implementations
     
     This is a helper class that can be inherited by implementation to implement
     ICachedItemMapper.  This class implements a get method that will automatically
     convert DATE, INT, and UNICODE type fields into the corresponding Python
-    Types.
+    Types.  The conversions needed for each column are worked out once per 
+    ICachedItem class (see _conversion_plan()), and re-used for every item.
+    
+    Cached item columns whose attribute names start with '_' are not mapped
+    from the source (they are managed by the cache area, see 
+    SqlObjectCacheArea).
     """
     
     #implements(ICachedItemMapper)
     mapper = {}
     _key = 'key_name_for_ICachedItem' # implementers to define this
+    _plan = None # (ICachedItem class, conversion plan) see _conversion_plan()
     
     def __init__(self, myCachedItemFactory):
         """
@@ -42,48 +83,68 @@ class SqlObjectMapperMixin(object):
     def factory(self):
         return self.myCachedItemFactory()
     
-    def get(self, sourceItem):
-        #TODO: take a serious look at this implementation...seems very holy (not in a religous sort of way)
-        _cachedItem = self.factory()
-        #_sqlInspecter = sqlalchemy.inspection.inspect(_cachedItem)
-        for _cachedAttrKeyName in _cachedItem.__class__.__dict__.keys(): # iterate the actual cache object to make sure we don't miss any attributes
-            if not isinstance(_cachedItem.__class__.__dict__[_cachedAttrKeyName], sqlalchemy.orm.attributes.InstrumentedAttribute): # these are the column assignments
+    def _conversion_plan(self, _class):
+        """Returns list of (attribute name, source key, converter) for _class
+        
+        The plan is built once per ICachedItem class by inspecting its column
+        assignments.  The converter is None for values that are assigned
+        without conversion.
+        
+        Raises:
+            LookupError: if a column attribute is not in the mapper keys
+        """
+        if self._plan and self._plan[0] is _class:
+            return self._plan[1]
+        _plan = []
+        for _cachedAttrKeyName, _attr in _class.__dict__.items(): # iterate the actual cache object to make sure we don't miss any attributes
+            if not isinstance(_attr, sqlalchemy.orm.attributes.InstrumentedAttribute): # these are the column assignments
+                continue
+            if _cachedAttrKeyName.startswith('_') and \
+                            _cachedAttrKeyName not in self.mapper: # managed by the cache area
                 continue
             if _cachedAttrKeyName not in self.mapper:
                 raise LookupError("expected to find cached object attribute in mapper keys: %s", _cachedAttrKeyName)
             
             _sourceAttrKey = self.mapper[_cachedAttrKeyName]
-            #if queryAdapter(_sourceAttrKey, IManagedCachedItemMapperAttributeKeyWrapper):
-            if IManagedCachedItemMapperAttributeKeyWrapper.providedBy(_sourceAttrKey):
-                _sourceAttrValue = sourceItem.attributes[_sourceAttrKey()]
+            _sql_field_type_name = str(_attr.property.columns[0].type).upper()
+            _managed = queryAdapter(_sourceAttrKey, IManagedCachedItemMapperAttribute)
+            if _managed: # MANAGED ATTRIBUTES
+                _convert = _manager(_managed)
+            elif 'INT' in _sql_field_type_name:
+                _convert = _int
+            elif 'NCHAR' in _sql_field_type_name:
+                _convert = _unicode
             else:
-                _sourceAttrValue = sourceItem.attributes[_sourceAttrKey]
-            _cachedAttrValue_new = None
-            _sql_field_type_name = str(_cachedItem.__table__.c[_cachedAttrKeyName].type)
-            
-            if queryAdapter(_sourceAttrKey, IManagedCachedItemMapperAttribute): # MANAGED ATTRIBUTES
-                _cachedAttrValue_new = None if not _sourceAttrValue else IManagedCachedItemMapperAttribute(_sourceAttrKey).manage(_sourceAttrValue)
-
-            elif 'INT' in _sql_field_type_name.upper():
-                try:
-                    _cachedAttrValue_new = int(_sourceAttrValue)
-                except ValueError:
-                    _cachedAttrValue_new = None
-            elif 'NCHAR' in _sql_field_type_name.upper():
-                _cachedAttrValue_new = _sourceAttrValue.decode('utf8', 'replace') if _sourceAttrValue else None
-            else:
-                _cachedAttrValue_new = _sourceAttrValue
-            
-            _cachedItem.__dict__[_cachedAttrKeyName] = _cachedAttrValue_new
+                _convert = None
+            if IManagedCachedItemMapperAttributeKeyWrapper.providedBy(_sourceAttrKey):
+                _sourceAttrKey = _sourceAttrKey()
+            _plan.append((_cachedAttrKeyName, _sourceAttrKey, _convert, ))
+        self._plan = (_class, _plan, )
+        return _plan
+    
+    def get(self, sourceItem):
+        _cachedItem = self.factory()
+        _attributes = sourceItem.attributes
+        _values = _cachedItem.__dict__
+        for _cachedAttrKeyName, _sourceAttrKey, _convert in \
+                                self._conversion_plan(_cachedItem.__class__):
+            _sourceAttrValue = _attributes[_sourceAttrKey]
+            _values[_cachedAttrKeyName] = _convert(_sourceAttrValue) \
+                                        if _convert else _sourceAttrValue
         logger.debug("generated cached item from source, values: %s", str(_cachedItem.getId()))
         return _cachedItem
     
     def check(self, sourceItem):
+        """True if sourceItem has all the attributes required by the conversion plan"""
         try:
-            self.get(sourceItem) # fails if a required field can not be found in source
+            _plan = self._conversion_plan(self.factory().__class__)
         except LookupError as e:
             logger.debug("Source item failed check due to error: %s", str(e))
             return False
+        for _cachedAttrKeyName, _sourceAttrKey, _convert in _plan:
+            if _sourceAttrKey not in sourceItem.attributes:
+                logger.debug("Source item failed check due to missing attribute: %s", str(_sourceAttrKey))
+                return False
         return True
 
 class SqlObjectCacheArea(object):
@@ -102,10 +163,65 @@ class SqlObjectCacheArea(object):
             - ICachableSource
             - ICachedItem (indirect...required for __init__)
           - ICachableItem (needed via method calls)
-        
-        
+    
+    Attributes:
+        import_batch_size: Integer number of source items that import_source()
+                           will look up with a single query.  When not set
+                           (the default), each item is looked up individually.
+        bulk_writes: When True, batched imports write new and modified items
+                     with a native upsert statement where the database 
+                     dialect supports one (SQLite, PostgreSQL, MySQL), or
+                     with executemany INSERT and UPDATE statements otherwise,
+                     instead of merging each item into the session.  Events 
+                     are issued for the ICachedItem generated by the mapper.
+        import_flush_size: Integer number of source items after which 
+                           import_source() flushes the session and expunges
+                           all of its objects, keeping session memory bounded
+                           for large sources.  Not set by default.
+        import_commit: When True (and import_flush_size is set), the session
+                       is also committed every import_flush_size items and
+                       when the import completes.  In that case rollback()
+                       only undoes changes made since the last of those
+                       commits.  Otherwise, flushed changes remain part of 
+                       the session transaction and rollback() undoes the 
+                       entire import.
+        reset_table: When True, reset() only empties the ICachedItem table 
+                     (with TRUNCATE where the dialect supports it, or a 
+                     single DELETE otherwise) instead of dropping and 
+                     re-creating all tables of the declarative base.  No 
+                     DDL is issued.  Note that some databases (e.g. MySQL) 
+                     implicitly commit the session transaction on TRUNCATE.
+        expiration_age: Python timedelta after which written items expire 
+                        (see Expiration).  Not set by default.
+    
+    Fingerprints:
+        If the ICachedItem class maps a column to the '_fingerprint' attribute
+        (e.g. _fingerprint = Column('fingerprint', String(40))), the area 
+        stores a SHA1 hash of each item's mapped values in it.  Dirty checks
+        then only query the stored fingerprint, and load the full cached 
+        entry only when the fingerprints differ.
+    
+    Expiration:
+        If the ICachedItem class maps a column to the '_expiration' attribute
+        (e.g. _expiration = Column('expiration', DateTime, index=True)), 
+        sweep() removes all entries whose expiration has passed with a 
+        single range DELETE statement, served by the column's index.  When
+        expiration_age is set, the area assigns each item it writes an 
+        expiration of expiration_age from the time of the write.  Otherwise
+        expirations are left to the ICachedItem (e.g. ageableCacheItemMixin).
+    
+    Item cache:
+        item_cache can be assigned a sparc.cache.lru.LRUCache instance to
+        keep the results of get() in memory, keyed by ICachableItem id.  
+        Entries are invalidated when items are cached, and all entries are
+        cleared by trim(), reset(), rollback() and session releases during
+        imports.  Hit and miss counts are available on the LRUCache.
+    
+    trim() always imports in batches (of import_batch_size, or 
+    DEFAULT_BATCH_SIZE when not set) and never commits the session, so 
+    import_commit does not apply to it.
     """
-    implements(ITransactionalCacheArea)
+    implements(ITransactionalCacheArea, ITrimmableCacheArea, ISweepableCacheArea)
     adapts(ISqlAlchemyDeclarativeBase, ISqlAlchemySession, ICachedItemMapper)
     
     def __init__(self, SqlAlchemyDeclarativeBase, SqlAlchemySession, CachedItemMapper):
@@ -114,6 +230,17 @@ class SqlObjectCacheArea(object):
         self.Base = SqlAlchemyDeclarativeBase
         self.session = SqlAlchemySession
         self.mapper = CachedItemMapper
+        self.import_batch_size = 0
+        self.bulk_writes = False
+        self.import_flush_size = 0
+        self.import_commit = False
+        self.reset_table = False
+        self.item_cache = None
+        self.expiration_age = None
+        self._fingerprinted_names = None
+        self._expiration = _marker
+        self._class = None
+        self._seen_created = [] # (connection info, key) of uncommitted tables
         
         if not isinstance(SqlAlchemySession, Session):
             raise TypeError("expected SQLAlchmey_session to be an instance of:"
@@ -129,10 +256,33 @@ class SqlObjectCacheArea(object):
         
         Returns: ICachedItem or None, if CachableItem has not been cached
         """
-        return self.session.\
-                        query(self.mapper.factory().__class__).\
-                        filter(self.mapper.factory().__class__.__dict__[self.mapper.key()]==CachableItem.getId()).\
+        if self.item_cache is not None:
+            _cachedItem = self.item_cache.get(CachableItem.getId(), _marker)
+            if _cachedItem is not _marker:
+                return _cachedItem
+        _class = self._model()
+        _cachedItem = self.session.query(_class).\
+                        filter(_class.__dict__[self.mapper.key()]==CachableItem.getId()).\
                         first()
+        if self.item_cache is not None:
+            self.item_cache.set(CachableItem.getId(), _cachedItem)
+        return _cachedItem
+    
+    def _model(self):
+        """Returns the ICachedItem class of the mapper"""
+        if self._class is None:
+            self._class = self.mapper.factory().__class__
+        return self._class
+    
+    def _invalidate(self, CachableItems=None):
+        """Removes item_cache entries for iterable of ICachableItem or all entries if not given"""
+        if self.item_cache is None:
+            return
+        if CachableItems is None:
+            self.item_cache.clear()
+            return
+        for CachableItem in CachableItems:
+            self.item_cache.invalidate(CachableItem.getId())
     
     def isDirty(self, CachableItem):
         """True if cached information requires update for ICachableItem
@@ -144,52 +294,592 @@ class SqlObjectCacheArea(object):
         """
         # we'll create a new ICachedItem from the current data and compare it to
         # ICachedItem we get from the DB
+        _newCacheItem = self._map(CachableItem)
+        if self._is_current(_newCacheItem):
+            return False
         _cachedItem = self.get(CachableItem)
         if not _cachedItem:
             return True
-        _newCacheItem = self.mapper.get(CachableItem)
         return False if _cachedItem == _newCacheItem else True
+    
+    def _fingerprint_names(self):
+        """Returns sorted list of fingerprinted attribute names or an empty list
         
-    def cache(self, CachableItem):
-        """Updates cache area with latest information
+        Fingerprints are only maintained for ICachedItem classes that map a
+        column to the '_fingerprint' attribute.
+        """
+        if self._fingerprinted_names is None:
+            _attrs = sqlalchemy.inspect(self._model()).column_attrs
+            self._fingerprinted_names = sorted(attr.key for attr in _attrs 
+                                    if not self._area_managed(attr.key)) \
+                                        if '_fingerprint' in _attrs else []
+        return self._fingerprinted_names
+    
+    def _area_managed(self, name):
+        """True for ICachedItem attribute names starting with '_' that are not
+           in the mapper, whose columns are left to the area
+        """
+        return name.startswith('_') and name not in self.mapper.mapper
+    
+    def _map(self, CachableItem):
+        """Returns ICachedItem for CachableItem with its fingerprint assigned"""
+        _newCacheItem = self.mapper.get(CachableItem)
+        _names = self._fingerprint_names()
+        if _names:
+            _values = tuple(getattr(_newCacheItem, name) for name in _names)
+            _newCacheItem._fingerprint = values_digest(_values)
+        if self.expiration_age and self._expiration_column() is not None:
+            _newCacheItem._expiration = datetime.now() + self.expiration_age
+        return _newCacheItem
+    
+    def _expiration_column(self):
+        """Returns the column mapped to the '_expiration' attribute or None"""
+        if self._expiration is _marker:
+            _attrs = sqlalchemy.inspect(self._model()).column_attrs
+            self._expiration = _attrs['_expiration'].columns[0] \
+                                    if '_expiration' in _attrs else None
+        return self._expiration
+    
+    def _is_current(self, _newCacheItem):
+        """True if the stored fingerprint for _newCacheItem matches its fingerprint"""
+        if not self._fingerprint_names():
+            return False
+        _class = _newCacheItem.__class__
+        return self.session.query(_class._fingerprint).\
+                    filter(_class.__dict__[self.mapper.key()] == _newCacheItem.getId()).\
+                    scalar() == _newCacheItem._fingerprint
+    
+    def _get_many(self, ids):
+        """Returns dict of cached ICachedItem keyed by id for the given ids
+        
+        Args:
+            ids: iterable of ICachedItem ids to find with a single query
+        """
+        _class = self._model()
+        return {_cachedItem.getId(): _cachedItem for _cachedItem in 
+                    self.session.query(_class).\
+                        filter(_class.__dict__[self.mapper.key()].in_(ids))}
+    
+    def _get_fingerprints(self, ids):
+        """Returns dict of stored fingerprints keyed by id for the given ids"""
+        _class = self._model()
+        _key = _class.__dict__[self.mapper.key()]
+        return dict(self.session.query(_key, _class._fingerprint).\
+                                                filter(_key.in_(ids)))
+    
+    def _cache(self, _cachedItem, _newCacheItem):
+        """Updates cache area with _newCacheItem given the currently cached _cachedItem
+        
+        Args:
+            _cachedItem: ICachedItem currently in the cache area or None
+            _newCacheItem: ICachedItem with the latest information
+        
+        Returns: the cached ICachedItem if updates were required, otherwise False
         """
-        _cachedItem = self.get(CachableItem)
         if not _cachedItem:
-            _dirtyCachedItem = self.mapper.get(CachableItem)
-            logger.debug("new cachable item added to sql cache area {id: %s, type: %s}", str(_dirtyCachedItem.getId()), str(_dirtyCachedItem.__class__))
-            cached_item = self.session.merge(_dirtyCachedItem)
-            notify(CacheObjectCreatedEvent(cached_item, self))
+            logger.debug("new cachable item added to sql cache area {id: %s, type: %s}", str(_newCacheItem.getId()), str(_newCacheItem.__class__))
+            cached_item = self.session.merge(_newCacheItem)
+            self._notify(CacheObjectCreatedEvent(cached_item, self))
+            return cached_item
+        elif _cachedItem != _newCacheItem:
+            logger.debug("Cachable item modified in sql cache area {id: %s, type: %s}", str(_newCacheItem.getId()), str(_newCacheItem.__class__))
+            cached_item = self.session.merge(_newCacheItem)
+            self._notify(CacheObjectModifiedEvent(cached_item, self))
             return cached_item
-        else:
-            _newCacheItem = self.mapper.get(CachableItem)
-            if _cachedItem != _newCacheItem:
-                logger.debug("Cachable item modified in sql cache area {id: %s, type: %s}", str(_newCacheItem.getId()), str(_newCacheItem.__class__))
-                cached_item = self.session.merge(_newCacheItem)
-                notify(CacheObjectModifiedEvent(cached_item, self))
-                return cached_item
         return False
     
-    def import_source(self, CachableSource):
-        """Updates cache area and returns number of items updated with all available entries in ICachableSource"""
+    def _notify(self, event):
+        notify(event)
+    
+    def cache(self, CachableItem):
+        """Updates cache area with latest information
+        """
+        _newCacheItem = self._map(CachableItem)
+        if self._is_current(_newCacheItem):
+            return False
+        cached_item = self._cache(self.get(CachableItem), _newCacheItem)
+        if cached_item:
+            self._invalidate([CachableItem])
+        return cached_item
+    
+    def _upsert(self, table, key, columns):
+        """Returns dialect specific upsert statement for table, updating the
+           given column names on conflict, or None if not supported
+        """
+        dialect = self.session.bind.dialect.name
+        columns = [c for c in columns if c != key.key]
+        try:
+            if dialect in ('postgresql', 'sqlite'):
+                statement = import_module('sqlalchemy.dialects.' + dialect).insert(table)
+                return statement.on_conflict_do_update(index_elements=[key], 
+                            set_={c: statement.excluded[c] for c in columns})
+            if dialect == 'mysql':
+                statement = import_module('sqlalchemy.dialects.mysql').insert(table)
+                return statement.on_duplicate_key_update(
+                            **{c: statement.inserted[c] for c in columns})
+        except (ImportError, AttributeError):
+            logger.debug("installed SQLAlchemy does not support upserts for dialect %s", dialect)
+        return None
+    
+    def _written_names(self):
+        """Returns set of the ICachedItem attribute names written by bulk 
+           statements: the mapped columns, plus the '_fingerprint' and 
+           '_expiration' columns when managed by the area
+        
+        Other columns starting with '_' that are not in the mapper are left
+        out, so that their defaults apply to new rows and their values are
+        kept for existing rows.
+        """
+        _names = set(attr.key for attr in 
+                            sqlalchemy.inspect(self._model()).column_attrs
+                                            if not self._area_managed(attr.key))
+        if self._fingerprint_names():
+            _names.add('_fingerprint')
+        if self.expiration_age and self._expiration_column() is not None:
+            _names.add('_expiration')
+        return _names
+    
+    def _write_many(self, created, modified):
+        """Writes lists of new and modified ICachedItem with bulk statements"""
+        _class = self._model()
+        _table = _class.__table__
+        _attrs = sqlalchemy.inspect(_class).column_attrs
+        _columns = [(attr.key, attr.columns[0].key) for attr in _attrs 
+                                        if attr.key in self._written_names()]
+        _key = _attrs[self.mapper.key()].columns[0]
+        def rows(items, prefix=''):
+            return [{prefix + c: getattr(item, a) for a, c in _columns} for item in items]
+        
+        self.session.flush() # pending ORM changes must be written first
+        _upsert = self._upsert(_table, _key, [c for a, c in _columns])
+        if _upsert is not None:
+            if created or modified:
+                self.session.execute(_upsert, rows(created + modified))
+            return
+        if created:
+            self.session.execute(_table.insert(), rows(created))
+        if modified:
+            _update = _table.update().\
+                where(_key == sqlalchemy.bindparam('b_' + _key.key)).\
+                values({c: sqlalchemy.bindparam('b_' + c) for a, c in _columns})
+            self.session.execute(_update, rows(modified, 'b_'))
+    
+    def _bulk_import_items(self, _cachedItems, _newCacheItems):
+        """Updates cache area with bulk statements, returning number of items updated
+        
+        Args:
+            _cachedItems: dict of currently cached ICachedItem keyed by id
+            _newCacheItems: list of ICachedItem with the latest information
+        """
+        _persisted = dict(_cachedItems)
+        _created, _modified = OrderedDict(), OrderedDict()
+        _events = []
+        for _newCacheItem in _newCacheItems:
+            _id = _newCacheItem.getId()
+            _cachedItem = _cachedItems.get(_id)
+            if not _cachedItem:
+                _created[_id] = _newCacheItem
+                _events.append(CacheObjectCreatedEvent(_newCacheItem, self))
+            elif _cachedItem != _newCacheItem:
+                if _id in _created: # source repeated a new id
+                    _created[_id] = _newCacheItem
+                else:
+                    _modified[_id] = _newCacheItem
+                _events.append(CacheObjectModifiedEvent(_newCacheItem, self))
+            else:
+                continue
+            _cachedItems[_id] = _newCacheItem
+        self._write_many(list(_created.values()), list(_modified.values()))
+        for _id in _modified:
+            self.session.expire(_persisted[_id]) # loaded rows are now stale
+        for event in _events:
+            self._notify(event)
+        logger.debug("bulk wrote %d new and %d modified items to sql cache area", len(_created), len(_modified))
+        return len(_events)
+    
+    def _import_items(self, CachableItems, seen=None):
+        """Updates cache area with a list of ICachableItem using a single lookup query
+        
+        Args:
+            CachableItems: list of ICachableItem
+            seen: optional sqlalchemy Table to record the ids of the items in
+        
+        Returns: number of items updated
+        """
+        self._invalidate(CachableItems)
+        _newCacheItems = [self._map(item) for item in CachableItems]
+        if seen is not None:
+            self.session.execute(seen.insert(), 
+                    [{'id': _id} for _id in set(item.getId() for item in _newCacheItems)])
+        if self._fingerprint_names():
+            # only items whose stored fingerprint differs need full comparison
+            _fingerprints = self._get_fingerprints([item.getId() for item in _newCacheItems])
+            _changed = []
+            for item in _newCacheItems:
+                if item.getId() in _fingerprints and \
+                            _fingerprints[item.getId()] == item._fingerprint:
+                    continue
+                _fingerprints[item.getId()] = None # source may repeat ids
+                _changed.append(item)
+            _newCacheItems = _changed
+            if not _newCacheItems:
+                return 0
+        _cachedItems = self._get_many([item.getId() for item in _newCacheItems])
+        if self.bulk_writes:
+            return self._bulk_import_items(_cachedItems, _newCacheItems)
         _count = 0
-        for item in CachableSource.items():
-            if self.cache(item):
+        for _newCacheItem in _newCacheItems:
+            cached_item = self._cache(_cachedItems.get(_newCacheItem.getId()), _newCacheItem)
+            if cached_item:
+                _cachedItems[cached_item.getId()] = cached_item # source may repeat ids
                 _count += 1
         return _count
+    
+    def import_source(self, CachableSource):
+        """Updates cache area and returns number of items updated with all available entries in ICachableSource
+        
+        When import_batch_size is set, source items are read in batches of 
+        that size and the cached versions of each batch are found with a
+        single query.
+        """
+        return self._import(CachableSource.items(), self.import_batch_size)
+    
+    def _import(self, CachableItems, batch_size, seen=None):
+        """Updates cache area with iterable of ICachableItem
+        
+        Args:
+            CachableItems: iterable of ICachableItem
+            batch_size: number of items to lookup per query, items are looked
+                        up individually if not set
+            seen: optional sqlalchemy Table to record imported item ids in, 
+                  requires batch_size.  The session is not committed when set.
+        
+        Returns: number of items updated
+        """
+        _count = 0
+        _pending = 0 # items imported since the last session release
+        for _items in chunks(CachableItems, batch_size or 1):
+            if batch_size:
+                _count += self._import_items(_items, seen)
+            else:
+                _count += sum(1 for item in _items if self.cache(item))
+            _pending += len(_items)
+            if self.import_flush_size and _pending >= self.import_flush_size:
+                self._release(commit=seen is None)
+                _pending = 0
+        if self.import_flush_size and _pending:
+            self._release(commit=seen is None)
+        return _count
+    
+    def import_source_parallel(self, CachableSource, SessionFactory, workers=4):
+        """Updates cache area with all available entries in ICachableSource using worker threads
+        
+        Source items are partitioned by the hash of their id across the 
+        workers, so a given id is always handled by the same worker.  Each
+        worker imports its partition with its own session (and therefore its
+        own database connection), using this area's import_batch_size, 
+        bulk_writes and import_flush_size settings.  Events are issued one at
+        a time (from the worker threads) with this area as the event area.
+        
+        Commit behaviour:
+            Workers never commit while importing (import_commit does not
+            apply).  Once every worker has finished, all worker sessions are
+            committed if all workers (and the source) succeeded, otherwise all
+            are rolled back and the first error is raised.  The worker commits
+            are not atomic: should one fail, its error is raised after the 
+            others have committed.  This area's session is not used (its 
+            item_cache is invalidated).  Note that the database must allow 
+            concurrent write transactions (e.g. PostgreSQL, MySQL InnoDB).
+        
+        Args:
+            CachableSource: ICachableSource to import
+            SessionFactory: callable returning new sqlalchemy Session 
+                            instances (e.g. a sqlalchemy.orm.sessionmaker)
+            workers: number of worker threads
+        
+        Returns: number of items updated
+        """
+        _lock = threading.Lock()
+        _areas = [_PartitionArea(self, SessionFactory(), _lock) for i in range(workers)]
+        _queues = [Queue((self.import_batch_size or DEFAULT_BATCH_SIZE) * 2) for i in range(workers)]
+        _results = [None] * workers
+        _errors = []
+        _imported = Queue() # workers report here once done importing
+        _decided = threading.Event()
+        _decision = {'commit': False}
+        
+        def work(index):
+            area = _areas[index]
+            items = iter(_queues[index].get, None)
+            try:
+                _results[index] = area._import(items, area.import_batch_size)
+                area.session.flush()
+            except Exception as e:
+                logger.exception("parallel import worker %d failed", index)
+                _results[index] = e
+                for item in items: # keep draining so the source can be fully partitioned
+                    pass
+            _imported.put(index)
+            _decided.wait()
+            try:
+                if _decision['commit']:
+                    area.session.commit()
+                else:
+                    area.session.rollback()
+            except Exception as e:
+                logger.exception("parallel import worker %d failed to end its transaction", index)
+                _errors.append(e)
+            finally:
+                area.session.close()
+        
+        _threads = [threading.Thread(target=work, args=(i,)) for i in range(workers)]
+        for thread in _threads:
+            thread.daemon = True
+            thread.start()
+        _partitioned = False
+        try:
+            for item in CachableSource.items():
+                _queues[hash(item.getId()) % workers].put(item)
+            _partitioned = True
+        finally:
+            for queue in _queues:
+                queue.put(None)
+            for thread in _threads:
+                _imported.get()
+            _errors.extend(r for r in _results if isinstance(r, Exception))
+            _decision['commit'] = _partitioned and not _errors
+            _decided.set()
+            for thread in _threads:
+                thread.join()
+            self._invalidate()
+        if _errors:
+            raise _errors[0]
+        logger.debug("parallel import with %d workers updated %s items", workers, str(_results))
+        return sum(_results)
+    
+    def _release(self, commit=True):
+        """Flushes (and optionally commits) session changes, then expunges all session objects"""
+        self.session.flush()
+        if commit and self.import_commit:
+            self.session.commit()
+        self.session.expunge_all()
+        self._invalidate()
+        logger.debug("released sql cache area session objects during import")
+        
+    def _seen_table(self):
+        """Returns temporary sqlalchemy Table to record imported item ids in"""
+        _class = self._model()
+        _key = sqlalchemy.inspect(_class).column_attrs[self.mapper.key()].columns[0]
+        return sqlalchemy.Table('sparc_cache_seen_' + _class.__table__.name, 
+                                sqlalchemy.MetaData(),
+                                sqlalchemy.Column('id', _key.type, index=True),
+                                prefixes=['TEMPORARY']), _key
+    
+    def _create_seen_table(self, _seen):
+        """Creates temporary table _seen the first time it is used on the 
+           session connection
         
+        The creation is recorded in the connection info, as checking for the
+        table on every trim would end the session transaction with drivers
+        that commit before other statements than DML (such as sqlite3).
+        Tables created within a rolled back transaction are checked for 
+        again, with a SELECT statement.
+        """
+        connection = self.session.connection()
+        key = ('sparc.cache.seen', _seen.name, )
+        created = connection.info.get(key)
+        if created:
+            return
+        if created is None:
+            _seen.create(bind=connection, checkfirst=True)
+        elif not self._seen_table_exists(connection, _seen):
+            _seen.create(bind=connection)
+        connection.info[key] = True
+        self._seen_created.append((connection.info, key, ))
+    
+    def _seen_table_exists(self, connection, _seen):
+        """True if temporary table _seen exists on connection"""
+        if connection.dialect.name == 'sqlite':
+            return bool(connection.execute(sqlalchemy.text(
+                    "SELECT count(*) FROM sqlite_temp_master WHERE name = :name"
+                    ).bindparams(name=_seen.name)).scalar())
+        return connection.dialect.has_table(connection, _seen.name)
+    
+    #ITrimmableCacheArea
+    def trim(self, source):
+        """Imports source, then removes cached items not found in source
+        
+        The ids of the imported items are recorded in a temporary table, and
+        the stale entries are removed with a single anti-join DELETE statement.
+        The temporary table is created the first time a session connection
+        is trimmed and is then emptied (not dropped) after each use, so that
+        no DDL runs within the session transaction that holds the changes
+        (drivers that commit before DDL, such as sqlite3, commit changes 
+        flushed before the first trim of a connection).
+        
+        Args:
+            source: either ICachableSource or a iterable of ICachableItem
+        
+        Returns: tuple of (number of items updated, number of items removed)
+        """
+        items = source.items() if ICachableSource.providedBy(source) else source
+        _seen, _key = self._seen_table()
+        self._create_seen_table(_seen)
+        self.session.execute(_seen.delete()) # left overs of a failed trim
+        updated = self._import(items, 
+                        self.import_batch_size or DEFAULT_BATCH_SIZE, _seen)
+        self.session.flush()
+        removed = self.session.execute(_key.table.delete().where(
+                    ~sqlalchemy.exists().where(_seen.c.id == _key))).rowcount
+        self.session.execute(_seen.delete())
+        self.session.expire_all() # removed entries may still be in the session
+        self._invalidate()
+        logger.debug("trimmed %d items from sql cache area", removed)
+        return (updated, removed, )
+    
+    #ISweepableCacheArea
+    def sweep(self, now=None):
+        """Removes expired entries with a single range DELETE statement
+        
+        Entries expire at the time stored in the column mapped to the 
+        '_expiration' attribute (see Expiration).  Nothing is removed for
+        ICachedItem classes without one.  Like trim(), sweeping happens 
+        within the session transaction.
+        
+        Args:
+            now: Python datetime to compare expirations to, defaults to now
+        
+        Returns: number of entries removed
+        """
+        _column = self._expiration_column()
+        if _column is None:
+            return 0
+        self.session.flush()
+        removed = self.session.execute(_column.table.delete().where(
+                    _column < (now or datetime.now()))).rowcount
+        self.session.expire_all() # removed entries may still be in the session
+        self._invalidate()
+        logger.debug("swept %d expired items from sql cache area", removed)
+        return removed
+    
     def commit(self):
         self.session.commit()
+        del self._seen_created[:]
         
     def rollback(self):
         self.session.rollback()
+        for info, key in self._seen_created: # created within the transaction
+            info[key] = False
+        del self._seen_created[:]
+        self._invalidate()
     
     def reset(self):
         """Deletes all entries in the cache area"""
+        self._invalidate()
+        if self.reset_table:
+            self._empty_table()
+            return
         self.Base.metadata.drop_all(self.session.bind)
         self.initialize()
+    
+    def _empty_table(self):
+        """Deletes all rows of the ICachedItem table within the session"""
+        _table = self._model().__table__
+        self.session.flush()
+        if self.session.bind.dialect.name in TRUNCATE_DIALECTS:
+            _preparer = self.session.bind.dialect.identifier_preparer
+            self.session.execute(sqlalchemy.text(
+                        "TRUNCATE TABLE " + _preparer.format_table(_table)))
+        else:
+            self.session.execute(_table.delete())
+        self.session.expire_all()
+        logger.debug("emptied sql cache area table %s", _table.name)
         
     def initialize(self):
         """Instantiates the cache area to be ready for updates"""
         self.Base.metadata.create_all(self.session.bind)
         logger.debug("initialized sqlalchemy orm tables")
-        
+
+class _PartitionArea(SqlObjectCacheArea):
+    """Cache area used by a SqlObjectCacheArea.import_source_parallel() worker"""
+    
+    def __init__(self, area, session, lock):
+        super(_PartitionArea, self).__init__(area.Base, session, area.mapper)
+        self.area = area
+        self.lock = lock
+        self.import_batch_size = area.import_batch_size
+        self.bulk_writes = area.bulk_writes
+        self.import_flush_size = area.import_flush_size
+        self.expiration_age = area.expiration_age
+    
+    def _notify(self, event):
+        event.area = self.area
+        with self.lock:
+            notify(event)
+
+class SqlObjectCacheAreaSource(object):
+    """ICachableSource of the items cached in a SqlObjectCacheArea
+    
+    This allows a populated cache area to seed other cache areas without 
+    going back to the original source.  Source items are 
+    sparc.cache.item.cachableItemMixin objects whose attributes are keyed by 
+    the cached item's attribute names (attributes starting with '_' that 
+    are not in the mapper are left out), and whose key is the cache area 
+    mapper's key.
+    
+    items() streams plain column values instead of ORM objects, fetching 
+    yield_per rows at a time via a server-side cursor where the database 
+    driver supports it, so memory use does not grow with the size of the 
+    cache area.  getById() is an indexed primary key lookup.
+    
+    Attributes:
+        yield_per: number of rows to fetch from the database at a time
+    """
+    implements(ICachableSource)
+    adapts(SqlObjectCacheArea)
+    
+    def __init__(self, SqlObjectCacheArea):
+        self.area = SqlObjectCacheArea
+        self.yield_per = DEFAULT_BATCH_SIZE
+        self._names = None
+    
+    def _columns(self):
+        """Returns list of (attribute name, column attribute) to read"""
+        _class = self.area._model()
+        if self._names is None:
+            self._names = sorted(_attr.key for _attr in 
+                                 sqlalchemy.inspect(_class).column_attrs
+                                 if not self.area._area_managed(_attr.key))
+        return [(_name, getattr(_class, _name), ) for _name in self._names]
+    
+    def _query(self):
+        _columns = self._columns()
+        return [_name for _name, _column in _columns], \
+                    self.area.session.query(*[_column for _name, _column in _columns])
+    
+    def _item(self, names, row):
+        return cachableItemMixin(self.key(), dict(zip(names, row)))
+    
+    def key(self):
+        """Returns string identifier key that marks unique item entries (e.g. primary key field name)"""
+        return self.area.mapper.key()
+    
+    def items(self):
+        """Returns a generator of the ICachableItem in the cache area"""
+        _names, _query = self._query()
+        _query = _query.execution_options(stream_results=True).\
+                                                    yield_per(self.yield_per)
+        for row in _query:
+            yield self._item(_names, row)
+    
+    def getById(self, Id):
+        """Returns ICachableItem that matches Id or None if not found"""
+        _names, _query = self._query()
+        row = _query.filter(getattr(self.area._model(), self.key()) == Id).first()
+        return self._item(_names, row) if row is not None else None
+    
+    def first(self):
+        """Returns the first ICachableItem available in the cache area or None"""
+        _names, _query = self._query()
+        row = _query.first()
+        return self._item(_names, row) if row is not None else None
@@ -0,0 +1,16 @@
+import os
+import zope.testrunner
+from sparc.testing.fixture import test_suite_mixin
+
+
+class test_suite(test_suite_mixin):
+    package = 'sparc.cache'
+    module = 'bloom'
+
+
+if __name__ == '__main__':
+    zope.testrunner.run([
+                         '--path', os.path.dirname(__file__),
+                         '--tests-pattern', os.path.splitext(
+                                                os.path.basename(__file__))[0]
+                         ])
\ No newline at end of file